@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''
+A local cache of built images held as OCI archive files.
+
+An archive is keyed by the I-node digest and a digest of the rendered
+Containerfile so that it is reused only when the inputs to the build are
+unchanged.  The cache directory may be on a volume shared between hosts.
+'''
+from pathlib import Path
+from .util import debug, digest
+from .podman import save_image, load_image, image_exists
+
+
+def cache_key(inode, containerfile):
+    '''
+    Return the cache key for an I-node and its rendered Containerfile.
+    '''
+    return digest([inode, digest(containerfile)])
+
+
+def archive_path(cache_dir, inode, containerfile):
+    '''
+    Return the path of the archive file for an I-node.
+    '''
+    return Path(cache_dir) / f'{cache_key(inode, containerfile)}.tar'
+
+
+def save(cache_dir, image, inode, containerfile):
+    '''
+    Save image to the cache unless already cached.
+
+    Return True if an archive was written.
+    '''
+    path = archive_path(cache_dir, inode, containerfile)
+    if path.exists():
+        debug(f'already cached: {image} as {path}')
+        return False
+    # Write aside and rename so a shared cache never exposes a partial file.
+    tmp = path.with_suffix('.tmp')
+    save_image(image, tmp)
+    tmp.rename(path)
+    return True
+
+
+def restore(cache_dir, image, inode, containerfile):
+    '''
+    Load image from the cache if cached.
+
+    Return True if the image was loaded.
+    '''
+    path = archive_path(cache_dir, inode, containerfile)
+    if not path.exists():
+        debug(f'not cached: {image} as {path}')
+        return False
+    load_image(path)
+    return image_exists(image)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+The state of a build run saved to resume it after a failure.
+
+The checkpoint file maps each I-node of the run to its image and the status of
+its build.  It is rewritten after each build so that it survives the run being
+aborted.
+'''
+import os
+import json
+from pathlib import Path
+
+from .util import warn
+
+# Statuses of I-nodes that need no more work.
+done_statuses = ("built", "exists", "restored", "skipped")
+
+
+class Checkpoint:
+    '''
+    The build state of a run.
+
+    If resume is True, the I-nodes that were done in a previous run are loaded
+    from path.  Those that failed or were blocked are to be built again.
+    '''
+    def __init__(self, path="winch-build-state.json", resume=False):
+        self.path = Path(path)
+        self.nodes = dict()
+        if resume:
+            if self.path.exists():
+                nodes = json.loads(self.path.read_text())["nodes"]
+                self.nodes = {n: s for n, s in nodes.items() if s["status"] in done_statuses}
+            else:
+                warn(f'no build state to resume: {self.path}')
+
+    def status(self, inode):
+        return self.nodes.get(inode, dict()).get("status")
+
+    def done(self, inode):
+        '''
+        Return True if the I-node needs no more work.
+        '''
+        return self.status(inode) in done_statuses
+
+    def count(self, status):
+        return sum(1 for s in self.nodes.values() if s["status"] == status)
+
+    def blocked_by(self, graph, inode):
+        '''
+        Return the ancestor of inode that failed or was blocked in this run, or None.
+        '''
+        for one in graph.ipath(inode)[:-1]:
+            if self.status(one) in ("failed", "blocked"):
+                return one
+
+    def mark(self, inode, image, status):
+        '''
+        Set the status of an I-node and save the state.
+        '''
+        self.nodes[inode] = dict(image=image, status=status)
+        self.save()
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(dict(nodes=self.nodes), indent=2))
+        os.replace(tmp, self.path)
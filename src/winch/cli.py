@@ -6,13 +6,27 @@ Command line interface to winch.
 
 import click
 
-from .util import setup_logging, debug, warn, error, self_format, assure_file, SafeDict, looks_like_digest
-from .config import load_many as load_configs
+from .util import setup_logging, debug, warn, error, self_format, assure_file, looks_like_digest, human_size
+from .util import template as compile_template
+from .config import load_many as load_configs, cachedir
 from .viz import write_dot
-from .graph import Graph
-from .podman import build_image, image_exists, remove_image, image_copy
+from .graph import Graph, diff as graph_diff
+from .podman import build_image, build_image_stream, image_exists, remove_image, image_copy, save_image, load_image
+from .podman import remove_images, list_images, short_name, inspect_images, Prefetch
+from .history import History
+from .checkpoint import Checkpoint
+from .containerfile import fuse as fuse_containerfiles, stage_name, canonical as canonical_text, explain as explain_text
+from .testing import run_tests, junit_xml
+from .registry import destination, PushRecord, push_many
+from .shard import partition, node_cost, default_costs
+from . import cache
 from pathlib import Path
 import functools
+import subprocess
+import time
+import sys
+import fnmatch
+import json
 
 # The implicit key to use when user does not provide key=value selector.  This
 # key is domain specific so should not be hard-wired but instead a top-level CLI
@@ -20,12 +34,15 @@ import functools
 instance_attribute = 'image'
 
 class Main:
-    def __init__(self, config=None,):
+    def __init__(self, config=None, jobs=1):
+        self.jobs = jobs
         if config is None:
             return
         self.opts = config.pop("winch",{})
         self.config = config
-        self._graph = Graph(**config)
+        self._graph = Graph()
+        self._graph.set_kinds(**config)
+        self._graph.generate(jobs)
 
     @property
     def graph(self):
@@ -43,9 +60,11 @@ cmddef = dict(context_settings = dict(auto_envvar_prefix='WINCH',
               help="log to a file [default:stdout]")
 @click.option("-L","--log-level", default="info",
               help="set logging level [default:info]")
+@click.option("-j","--jobs", default=1, type=int,
+              help="Number of processes used to generate the graph [default:1]")
 @click.group("winch", **cmddef)
 @click.pass_context
-def cli(ctx, config, log_output, log_level):
+def cli(ctx, config, log_output, log_level, jobs):
     '''
     winch - Wire-Cell Toolkit image node container harness
     '''
@@ -55,7 +74,7 @@ def cli(ctx, config, log_output, log_level):
     except FileNotFoundError:
         cfg = None
 
-    ctx.obj = Main(cfg)
+    ctx.obj = Main(cfg, jobs)
     return
 
 
@@ -119,16 +138,18 @@ def select_inodes(ctx, kpath=None, kind=None, deps=None, instances=None, none_is
     if instances == "all":
         return ctx.obj.graph.I.nodes
 
-    print(f'{instances=}')
+    debug(f'{instances=}')
     return to_nodes(ctx.obj.graph.I, instances.split(","))
 
 
-def selection(none_is_all=False):
+def selection(none_is_all=False, replaced_by=None):
     def decorator(func):
         '''
         A decorator for a command applied to a selection of I-nodes.
 
-        It provides a single 'inodes' attribute
+        It provides a single 'inodes' attribute.  If replaced_by names an
+        option of the command that, when given, replaces the selection then
+        an empty selection is not warned about.
         '''
         @click.option("-k","--kind", default=None, type=str,
                       help='Limit to I-nodes made from K-node regardless of path')
@@ -144,7 +165,7 @@ def selection(none_is_all=False):
             deps = kwds.pop('deps',None)
             instances = kwds.pop('instances',None)
             inodes = select_inodes(ctx, kpath, kind, deps, instances, none_is_all)
-            if not inodes:
+            if not inodes and not (replaced_by and kwds.get(replaced_by)):
                 warn(f'no instances found')
             kwds['inodes'] = inodes
             return func(*args, **kwds)
@@ -158,12 +179,60 @@ def cmd_config(ctx):
     import json
     print(json.dumps(ctx.obj.config))
 
+def tsv_value(value):
+    '''
+    Return value as a single TSV cell.
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        value = ','.join(str(v) for v in value)
+    elif isinstance(value, dict):
+        value = json.dumps(value)
+    else:
+        value = str(value)
+    return value.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n')
+
+
+def list_records(gr, inodes, fmt, fields):
+    '''
+    Yield one line of text for each I-node in the jsonl or tsv format.
+
+    Only the named fields are accessed.  The "node" and "ntype" fields are
+    provided implicitly.  Without fields, jsonl gives all attributes.
+    '''
+    def get(inode, data, field):
+        if field == "node":
+            return inode
+        if field == "ntype":
+            return 'I'
+        return data.get(field)
+
+    for inode in inodes:
+        data = gr.data(inode)
+        if fmt == "jsonl":
+            if fields:
+                rec = {f: get(inode, data, f) for f in fields}
+            else:
+                rec = dict(node=inode, **data)
+            yield json.dumps(rec) + '\n'
+        else:
+            yield '\t'.join(tsv_value(get(inode, data, f)) for f in fields) + '\n'
+
+
 @cli.command("list")
 @selection(none_is_all=True)
 @click.option("-t","--template", default="{image}",
               help="The template for display")
+@click.option("-F","--format", "fmt", default="template",
+              type=click.Choice(["template","jsonl","tsv"]),
+              help="Output format, template uses -t/--template")
+@click.option("--fields", default=None, type=str,
+              help='Comma-separated attributes for jsonl or tsv [default:all for jsonl, "node,image" for tsv]')
+@click.option("--chunk", default=1000, type=int,
+              help="Number of records written to output at a time")
 @click.pass_context
-def cmd_list(ctx, inodes, template):
+def cmd_list(ctx, inodes, template, fmt, fields, chunk):
     '''
     List things about the winch graph.
 
@@ -181,20 +250,102 @@ def cmd_list(ctx, inodes, template):
     Providing -i/--instances gives a comma-separated list of I-node, each specified
     by a node name (hash) or an "key=value" attribute.  A special entry "all"
     will match all I-nodes.
+
+    Providing -F/--format of jsonl or tsv streams one record per I-node with
+    the attributes named by --fields.
     '''
-    template = template.replace('\\n','\n').replace('\\t','\t')
-    for inode in inodes:
-        data = ctx.obj.graph.data(inode)
-        string = template.format_map(SafeDict(ntype='I', node=inode, **data))
-        print(string)
+    gr = ctx.obj.graph
+    if fmt == "template":
+        template = template.replace('\\n','\n').replace('\\t','\t')
+        items = ((inode, gr.data(inode)) for inode in inodes)
+        for string in compile_template(template).render_many(items, ntype='I'):
+            print(string)
+        return
+
+    if fields:
+        fields = fields.split(",")
+    elif fmt == "tsv":
+        fields = ["node", instance_attribute]
+
+    out = sys.stdout
+    buf = list()
+    for record in list_records(gr, inodes, fmt, fields):
+        buf.append(record)
+        if len(buf) >= chunk:
+            out.write(''.join(buf))
+            out.flush()
+            buf.clear()
+    out.write(''.join(buf))
+    out.flush()
 
     
 
+def load_graph(configs, jobs=1):
+    '''
+    Return a Graph made from config file paths, each may be comma-separated.
+    '''
+    cfg = load_configs(*configs)
+    cfg.pop("winch", None)
+    gr = Graph()
+    gr.set_kinds(**cfg)
+    gr.generate(jobs)
+    return gr
+
+
+@cli.command("diff")
+@click.option("-k","--key", default=instance_attribute,
+              help="Attribute matching I-nodes whose digests differ")
+@click.option("-F","--format", "fmt", default="selection",
+              type=click.Choice(["selection","report","json"]),
+              help="Output format, selection is for use with -i/--instances")
+@click.option("-c","--config", "old", multiple=True, required=True,
+              help="Specify a config file of the old configuration")
+@click.option("-c2","--config2", "new", multiple=True, required=True,
+              help="Specify a config file of the new configuration")
+@click.pass_context
+def cmd_diff(ctx, key, fmt, old, new):
+    '''
+    Report instances changed between old and new configurations.
+
+    The old configuration is given by -c/--config and the new by -c2/--config2,
+    each as for the "winch -c/--config" option.  To compare git revisions pass
+    files extracted from each, eg "-c <(git show main:wct.toml)".
+
+    Instances are added, removed or modified.  An instance is modified if its
+    key attribute (default "image") is unchanged but its digest differs or if
+    it descends from an added or modified instance.
+
+    The default output is a comma-separated list of the digests of the added
+    and modified instances of NEW that may be given to "winch build -i".
+    '''
+    old_gr = load_graph(old, ctx.obj.jobs)
+    new_gr = load_graph(new, ctx.obj.jobs)
+    added, removed, modified = graph_diff(old_gr, new_gr, key)
+
+    if fmt == "selection":
+        changed = set(added + modified)
+        print(','.join(n for n in new_gr.I.nodes if n in changed))
+        return
+
+    def described(gr, inodes):
+        return [dict(node=n, **{key: gr.data(n).get(key)}) for n in inodes]
+
+    if fmt == "json":
+        print(json.dumps(dict(added=described(new_gr, added),
+                              removed=described(old_gr, removed),
+                              modified=described(new_gr, modified)), indent=2))
+        return
+
+    for mark, gr, inodes in (("+", new_gr, added), ("-", old_gr, removed), ("~", new_gr, modified)):
+        for inode in inodes:
+            print(f'{mark} {inode} {gr.data(inode).get(key, "")}')
+
+
 @cli.command("build", context_settings=dict(
     ignore_unknown_options=True,
     allow_extra_args=True # This is also useful for accepting arguments after known options
 ))
-@selection()
+@selection(replaced_by="manifest")
 @click.option("--containerfile-attribute", default="containerfile",
               help="Name the attribute providing the Containerfile content")
 @click.option("--image-attribute", default="image",
@@ -207,9 +358,37 @@ def cmd_list(ctx, inodes, template):
               help="Force a rebuild by removing existing image that maps the selector")              
 @click.option("-o","--outpath", default='winch-contexts/{image}/Containerfile',
               help='A file path name for output files, may include "{format}" markup')
+@click.option("-m","--manifest", default=None, type=click.Path(exists=True, dir_okay=False),
+              help='Build the I-nodes of a shard manifest made by "winch shard"')
+@click.option("-C","--cache-dir", default=None,
+              help='Restore missing images from this image cache before building')
+@click.option("--history/--no-history", default=True,
+              help="Record builds in and schedule from the build history")
+@click.option("--history-db", default=None,
+              help="The build history database [default:~/.cache/winch/history.db]")
+@click.option("--fuse", is_flag=True, default=False,
+              help="Build each chain of selected I-nodes with one multi-stage Containerfile")
+@click.option("--tag-stages", is_flag=True, default=False,
+              help="With --fuse, also tag the images of intermediate stages")
+@click.option("--pull-jobs", default=4, type=int,
+              help="Number of concurrent pulls of missing base images, 0 disables")
+@click.option("--stream", is_flag=True, default=False,
+              help="Send the build context to podman on stdin instead of writing it to --outpath")
+@click.option("--canonical", is_flag=True, default=False,
+              help="Put each Containerfile in canonical form before building")
+@click.option("--explain", is_flag=True, default=False,
+              help="Implies --canonical and shows what canonical form changes")
+@click.option("--keep-going", is_flag=True, default=False,
+              help="Continue with the builds that do not depend on a failed build")
+@click.option("--resume", is_flag=True, default=False,
+              help="Build only what was not done by the run that saved --state")
+@click.option("--state", "state_file", default="winch-build-state.json",
+              help="File saving the state of the run for --resume")
 @click.argument("args", nargs=-1, type=click.UNPROCESSED)
 @click.pass_context
-def build(ctx, inodes, containerfile_attribute, image_attribute, rebuild, force, outpath, args):
+def build(ctx, inodes, containerfile_attribute, image_attribute, rebuild, force, outpath, manifest, cache_dir,
+          history, history_db, fuse, tag_stages, pull_jobs, stream, canonical, explain,
+          keep_going, resume, state_file, args):
     '''
     Build container images from I-nodes.
 
@@ -220,20 +399,112 @@ def build(ctx, inodes, containerfile_attribute, image_attribute, rebuild, force,
 
     The --force option will remove an image and thus cause a rebuild regardless
     if one is needed or not.
+
+    The --manifest option replaces the selection with the I-nodes of a shard.
+    Archives the shard needs are loaded before and those it provides are
+    saved after building.
+
+    The --cache-dir option names an image cache made with "winch cache save".
+    A missing image found there is loaded instead of being built.
+
+    Each build is recorded in the build history (see "winch history").  Past
+    build durations order the builds so that the I-nodes heading the longest
+    critical paths start first.
+
+    The --fuse option combines each chain of selected I-nodes into one
+    multi-stage Containerfile built by a single podman call.  Only the image
+    of the last I-node in the chain is tagged unless --tag-stages is given or
+    the image is saved by the --manifest.  With --fuse, --force and --rebuild
+    apply to whole chains and so may only be "none" or "all" and --cache-dir
+    is not supported.  Fused builds are not recorded in
+    the build history as their durations are not those of single I-nodes.
+
+    Missing base images (those of root I-nodes lacking a Containerfile) are
+    pulled concurrently as soon as the selection is known and each build
+    waits only for its own base.
+
+    The --stream option assembles the build context in memory and sends it to
+    podman as a tar archive on its standard input.  Nothing is written to the
+    --outpath directory.
+
+    The --canonical option rewrites each Containerfile so that cosmetic
+    changes to whitespace, line continuations and comments do not change its
+    text and so do not invalidate the podman layer cache.  Words or
+    instructions between "# winch: sort" and "# winch: end" comment lines are
+    sorted.  The --explain option also prints the changes as a diff.
+
+    The status of each I-node is saved to the --state file as the run goes.
+    A failed build ends the run unless --keep-going is given, in which case
+    only the I-nodes that depend on the failed one are not built and the exit
+    code is non-zero at the end.  The --resume option builds only the I-nodes
+    that failed or were not built in the saved run, without checking again on
+    those that are done.
     '''
+    gr = ctx.obj.graph
+    if fuse:
+        if force not in ("none", "all") or rebuild not in ("none", "all"):
+            raise click.UsageError('--fuse supports only "none" or "all" for --force and --rebuild')
+        if cache_dir:
+            raise click.UsageError('--fuse can not be used with --cache-dir')
+    canon = None
+    if canonical or explain:
+        canon = functools.partial(canonical_containerfile, explain=explain)
+
+    if manifest:
+        manifest = json.loads(Path(manifest).read_text())
+        for archive in manifest["load"]:
+            print(f'loading image archive: {archive}')
+            load_image(archive)
+        inodes = manifest["build"]
+
+    inodes = list(inodes)
+    if not inodes:
+        return
+    last = inodes[-1]
+
+    state = Checkpoint(state_file, resume)
+    if resume:
+        todo = [n for n in inodes if not state.done(n)]
+        print(f'resuming build of {len(todo)} of {len(inodes)} instances')
+        inodes = todo
+        if not inodes:
+            return
+
+    costs = None
+    if history:
+        history = History(history_db)
+        costs = history.costs()
+    inodes = gr.schedule(inodes, cost_function(gr, costs, containerfile_attribute, image_attribute))
+
+    bases = base_images(gr, inodes, containerfile_attribute, image_attribute)
+    pulls = Prefetch(missing_images(set(bases.values())) if pull_jobs > 0 else [], pull_jobs)
+
+    if fuse:
+        tag_images = set(manifest["save"]) if manifest else set()
+        build_fused(gr, inodes, containerfile_attribute, image_attribute, rebuild, force, outpath,
+                    tag_stages, tag_images, args, pulls, bases, stream, canon, state, keep_going)
+        inodes = []
+
     for inode in inodes:
-        idata = ctx.obj.graph.data(inode)
+        idata = gr.data(inode)
         image = idata[image_attribute]
 
+        blocker = state.blocked_by(gr, inode)
+        if blocker:
+            print(f'not building {image} which depends on failed {gr.data(blocker)[image_attribute]}')
+            state.mark(inode, image, "blocked")
+            continue
+
         exists = image_exists(image)
         debug(f'{exists=} {inode=} {image=} {force=} {rebuild=}')
 
         extra_args = list()
-        if (force == "all"
-            or
-            (force == "deps" and inode != inodes[-1])
-            or
-            (force == "last" and inode == inodes[-1])):
+        forced = (force == "all"
+                  or
+                  (force == "deps" and inode != last)
+                  or
+                  (force == "last" and inode == last))
+        if forced:
             print(f'force-removing existing image: {image}')
             remove_image(image)
             extra_args.append("--no-cache")
@@ -242,24 +513,34 @@ def build(ctx, inodes, containerfile_attribute, image_attribute, rebuild, force,
         if exists and (
                 rebuild == "none" 
                 or
-                (rebuild == "deps" and inode == inodes[-1])
+                (rebuild == "deps" and inode == last)
                 or
-                (rebuild == "last" and inode != inodes[-1])):
+                (rebuild == "last" and inode != last)):
             print(f'not rebuilding existing image: {image}')
+            state.mark(inode, image, "exists")
             continue
         try:
             cfile = idata[containerfile_attribute]
         except KeyError:
             debug(f'{inode} "{image}" lacks {containerfile_attribute}, skipping')
+            state.mark(inode, image, "skipped")
             continue
-        cpath = outpath.format(node=inode, **idata)
-        assure_file(cpath, cfile)
+        # The cache is keyed on the Containerfile as configured, as by "cache save".
+        if cache_dir and not exists and not forced:
+            if cache.restore(cache_dir, image, inode, cfile):
+                print(f'restored image from cache: {image}')
+                state.mark(inode, image, "restored")
+                continue
+
+        if canon:
+            cfile = canon(image, cfile)
 
-        for fpath, fcont in idata.pop('files', {}).items():
+        cpath = compile_template(outpath).render(idata, node=inode)
+        files = dict()
+        for fpath, fcont in idata.get('files', {}).items():
             debug(f'{fpath=}\n{fcont}\n')
-            fpath = Path(cpath).parent / fpath.format(node=inode, **idata)
-            fcont = fcont.format_map(SafeDict(node=inode, **idata))
-            assure_file(fpath, fcont)
+            fpath = compile_template(fpath).render(idata, node=inode)
+            files[fpath] = compile_template(fcont).render(idata, node=inode)
 
         debug(f'{idata=}')
         image_format = idata.get("image_format", None)
@@ -268,7 +549,730 @@ def build(ctx, inodes, containerfile_attribute, image_attribute, rebuild, force,
             extra_args.append(f'--format={image_format}')
 
         extra_args += args
-        build_image(image, cpath, *extra_args)
+        try:
+            pulls.wait(bases.get(inode))
+        except RuntimeError as err:
+            state.mark(inode, image, "failed")
+            if not keep_going:
+                raise
+            warn(f'failed to pull base image of {image}: {err}')
+            continue
+        started = time.time()
+        # Any error other than a failed build, such as an interrupt, is
+        # recorded with this status so its duration is not taken as a cost.
+        status = -1
+        try:
+            build_context(image, cpath, cfile, files, stream, extra_args)
+            status = 0
+        except subprocess.CalledProcessError as err:
+            status = err.returncode
+            state.mark(inode, image, "failed")
+            if not keep_going:
+                raise
+            warn(f'failed to build {image}')
+            continue
+        finally:
+            if history:
+                record_build(history, inode, image, started, status)
+        state.mark(inode, image, "built")
+
+    pulls.shutdown()
+
+    failed = state.count("failed")
+    if failed:
+        raise click.ClickException(f'{failed} builds failed and {state.count("blocked")} were not built, '
+                                   f'see {state_file} and use --resume after fixing')
+
+    if manifest:
+        for image, archive in manifest["save"].items():
+            print(f'saving image archive: {archive}')
+            save_image(image, archive)
+
+
+def cost_function(gr, costs, containerfile_attribute, image_attribute):
+    '''
+    Return a function of an I-node giving its estimated build cost.
+
+    The costs are from the build history, if any.  I-nodes missing from the
+    history are estimated from those of their kind.
+    '''
+    defaults = default_costs(gr, costs, containerfile_attribute, image_attribute) if costs else None
+    return functools.partial(node_cost, gr, costs=costs, defaults=defaults,
+                             containerfile_attribute=containerfile_attribute,
+                             image_attribute=image_attribute)
+
+
+def base_images(gr, inodes, containerfile_attribute, image_attribute):
+    '''
+    Return mapping from I-node to the image of its root I-node.
+
+    Only I-nodes with a Containerfile and a root I-node without one are
+    included.  These base images are pulled, not built.
+    '''
+    ret = dict()
+    for inode in inodes:
+        if containerfile_attribute not in gr.data(inode):
+            continue
+        root = gr.data(gr.ipath(inode)[0])
+        if containerfile_attribute in root or image_attribute not in root:
+            continue
+        ret[inode] = root[image_attribute]
+    return ret
+
+
+def missing_images(images):
+    '''
+    Return the images that do not exist locally, in sorted order.
+    '''
+    return [i for i in sorted(images) if not image_exists(i)]
+
+
+@cli.command("pull")
+@selection(none_is_all=True)
+@click.option("--containerfile-attribute", default="containerfile",
+              help="Name the attribute providing the Containerfile content")
+@click.option("--image-attribute", default="image",
+              help="Name the attribute providing the image name")
+@click.option("-j","--jobs", default=4, type=int,
+              help="Number of concurrent pulls")
+@click.pass_context
+def cmd_pull(ctx, inodes, containerfile_attribute, image_attribute, jobs):
+    '''
+    Pull the missing base images of the selection.
+
+    Base images are those of root I-nodes lacking a Containerfile.
+    '''
+    gr = ctx.obj.graph
+    images = set()
+    for inode in inodes:
+        root = gr.data(gr.ipath(inode)[0])
+        if containerfile_attribute not in root and image_attribute in root:
+            images.add(root[image_attribute])
+    missing = missing_images(images)
+    pulls = Prefetch(missing, jobs)
+    for image in missing:
+        pulls.wait(image)
+        print(f'pulled image: {image}')
+    pulls.shutdown()
+
+
+@cli.command("push", context_settings=dict(
+    ignore_unknown_options=True,
+    allow_extra_args=True,
+))
+@selection()
+@click.option("-r","--registry", required=True,
+              help='Registry prefix or a template for the destination, eg "ghcr.io/org/{image}"')
+@click.option("--image-attribute", default="image",
+              help="Name the attribute providing the image name")
+@click.option("-j","--jobs", default=4, type=int,
+              help="Number of concurrent pushes")
+@click.option("--tls-verify/--no-tls-verify", default=True,
+              help="Require HTTPS and verify certificates of the registry")
+@click.option("-f","--force", is_flag=True, default=False,
+              help="Push even if the registry already has the image")
+@click.option("--record", default=None,
+              help="File recording past pushes, default is in the winch cache directory")
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.pass_context
+def cmd_push(ctx, inodes, registry, image_attribute, jobs, tls_verify, force, record, args):
+    '''
+    Push the selected images to a registry.
+
+    Images are pushed concurrently with each parent pushed before its
+    children.  A push is skipped if the image is unchanged since it was last
+    pushed and the registry still has the digest then pushed.  Any ARGS are
+    passed to "podman push".  The exit code is non-zero if any push fails.
+    '''
+    gr = ctx.obj.graph
+    pushes = list()
+    for inode in inodes:
+        idata = gr.data(inode)
+        image = idata.get(image_attribute)
+        if not image:
+            continue
+        if not image_exists(image):
+            warn(f'not pushing missing image: {image}')
+            continue
+        pushes.append((inode, image, destination(registry, idata, image_attribute, node=inode)))
+
+    record = PushRecord(record)
+    try:
+        results = push_many(gr, pushes, record, jobs, tls_verify, force, args)
+    finally:
+        record.save()
+
+    failed = False
+    for res in results:
+        print(f'{res["status"]}: {res["image"]} -> {res["dest"]}')
+        if res["status"] not in ("pushed", "present"):
+            warn(f'push {res["status"]}: {res["image"]}')
+            failed = True
+    if failed:
+        ctx.exit(1)
+
+
+def fused_chains(gr, inodes, containerfile_attribute):
+    '''
+    Return list of chains of selected I-nodes that have a Containerfile.
+
+    Each chain is a list of I-nodes, each the I-graph parent of the next, and
+    ends with an I-node that has no selected child.
+    '''
+    inodes = [n for n in inodes if containerfile_attribute in gr.data(n)]
+    selected = set(inodes)
+    chains = list()
+    for leaf in inodes:
+        if any(c in selected for c in gr.I.successors(leaf)):
+            continue
+        chain = [leaf]
+        while True:
+            parent = next(iter(gr.I.predecessors(chain[-1])), None)
+            if parent not in selected:
+                break
+            chain.append(parent)
+        chain.reverse()
+        chains.append(chain)
+    return chains
+
+
+def canonical_containerfile(image, text, explain=False):
+    '''
+    Return the Containerfile text of image in canonical form.
+
+    If explain is True, print how the text changes.
+    '''
+    try:
+        canon = canonical_text(text)
+    except ValueError as err:
+        raise click.ClickException(f'can not make canonical Containerfile for {image}: {err}')
+    if explain:
+        diff = explain_text(text, canon, f'{image}/Containerfile')
+        print(diff or f'canonical Containerfile unchanged: {image}\n', end='')
+    return canon
+
+
+def build_context(image, cpath, containerfile, files, stream, args):
+    '''
+    Build image from Containerfile text and context files.
+
+    The files maps paths relative to the Containerfile to their content.  If
+    stream is True, the context is sent to podman in memory, otherwise it is
+    written to the directory holding the Containerfile at path cpath.
+    '''
+    if stream:
+        return build_image_stream(image, dict(files, Containerfile=containerfile), *args)
+    assure_file(cpath, containerfile)
+    for fpath, fcont in files.items():
+        assure_file(Path(cpath).parent / fpath, fcont)
+    return build_image(image, cpath, *args)
+
+
+def build_fused(gr, inodes, containerfile_attribute, image_attribute, rebuild, force, outpath,
+                tag_stages, tag_images, args, pulls, bases, stream, canon, state, keep_going):
+    '''
+    Build each chain of I-nodes with one multi-stage Containerfile.
+
+    Images of intermediate stages are tagged if tag_stages is True or if they
+    are in tag_images.
+
+    If canon is given, it is applied to each layer's image and Containerfile
+    to return the Containerfile to fuse.  The status of all I-nodes of a chain
+    is marked in the state as one.
+    '''
+    for chain in fused_chains(gr, inodes, containerfile_attribute):
+        leaf = chain[-1]
+        ldata = gr.data(leaf)
+        image = ldata[image_attribute]
+
+        def mark(status):
+            for inode in chain:
+                state.mark(inode, gr.data(inode)[image_attribute], status)
+
+        blocker = state.blocked_by(gr, chain[0])
+        if blocker:
+            print(f'not building {image} which depends on failed {gr.data(blocker)[image_attribute]}')
+            mark("blocked")
+            continue
+
+        extra_args = list()
+        if force != "none":
+            print(f'force-removing existing image: {image}')
+            remove_image(image)
+            extra_args.append("--no-cache")
+        elif rebuild == "none" and image_exists(image):
+            print(f'not rebuilding existing image: {image}')
+            mark("exists")
+            continue
+
+        layers = list()
+        files = dict()
+        for num, inode in enumerate(chain):
+            idata = gr.data(inode)
+            parent = next(iter(gr.I.predecessors(inode)), None)
+            pimage = gr.data(parent)[image_attribute] if parent else None
+            text = idata[containerfile_attribute]
+            if canon:
+                text = canon(idata[image_attribute], text)
+            layers.append((stage_name(num, idata["kind"]), pimage, text))
+            for fpath, fcont in idata.get('files', {}).items():
+                fpath = compile_template(fpath).render(idata, node=inode)
+                fcont = compile_template(fcont).render(idata, node=inode)
+                if files.get(fpath, fcont) != fcont:
+                    raise click.ClickException(f'fused layers have different content for file {fpath}')
+                files[fpath] = fcont
+        try:
+            cfile = fuse_containerfiles(layers)
+        except ValueError as err:
+            raise click.ClickException(f'can not fuse {image}: {err}')
+
+        cpath = compile_template(outpath).render(ldata, node=leaf)
+
+        image_format = ldata.get("image_format", None)
+        if image_format:
+            extra_args.append(f'--format={image_format}')
+        extra_args += args
+
+        print(f'building {len(chain)} fused layers: {image}')
+        try:
+            pulls.wait(bases.get(leaf))
+        except RuntimeError as err:
+            mark("failed")
+            if not keep_going:
+                raise
+            warn(f'failed to pull base image of {image}: {err}')
+            continue
+        try:
+            build_context(image, cpath, cfile, files, stream, extra_args)
+        except subprocess.CalledProcessError:
+            mark("failed")
+            if not keep_going:
+                raise
+            warn(f'failed to build {image}')
+            continue
+        mark("built")
+
+        # The stages are cached by the build above so these are quick.  They
+        # take the same arguments to hit that cache but for --no-cache which
+        # would build them again.
+        stage_args = [a for a in extra_args if a != "--no-cache"]
+        for (stage, _, _), inode in zip(layers[:-1], chain[:-1]):
+            simage = gr.data(inode)[image_attribute]
+            if not (tag_stages or simage in tag_images):
+                continue
+            try:
+                build_context(simage, cpath, cfile, files, stream, ["--target", stage] + stage_args)
+            except subprocess.CalledProcessError:
+                state.mark(inode, simage, "failed")
+                if not keep_going:
+                    raise
+                warn(f'failed to tag stage image {simage}')
+
+
+def record_build(history, inode, image, started, status):
+    '''
+    Record a build in the history including the image ID and size if built.
+    '''
+    duration = time.time() - started
+    image_id = size = None
+    if status == 0:
+        try:
+            info, = inspect_images([image])
+            image_id, size = info.get("Id"), info.get("Size")
+        except (subprocess.CalledProcessError, ValueError) as err:
+            warn(f'failed to inspect built image {image}: {err}')
+    history.record(inode, image, started, duration, status, image_id, size)
+
+
+@cli.command("history")
+@click.option("--history-db", default=None,
+              help="The build history database [default:~/.cache/winch/history.db]")
+@click.option("-n","--slowest", default=10, type=int,
+              help="Number of slowest images to report")
+@click.option("-i","--image", default=None, type=str,
+              help="Report the build trend of one image")
+@click.option("--regressions", is_flag=True, default=False,
+              help="Report images whose latest build took longer than before")
+@click.option("--factor", default=1.5, type=float,
+              help="The slow down factor considered a regression")
+def cmd_history(history_db, slowest, image, regressions, factor):
+    '''
+    Report on the build history recorded by "winch build".
+
+    By default the images that are slowest to build are listed.
+    '''
+    history = History(history_db)
+    if image:
+        for rec in history.builds(image):
+            when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(rec["started"]))
+            size = human_size(rec["size"]) if rec["size"] is not None else "-"
+            print(f'{when} {rec["duration"]:10.1f} s {rec["status"]:3d} {size:>10} {rec["inode"]}')
+        return
+
+    if regressions:
+        for name, latest, prior in history.regressions(factor):
+            print(f'{latest:10.1f} s {prior:10.1f} s {latest/prior:6.2f}x {name}')
+        return
+
+    for name, duration, count in history.slowest(slowest):
+        print(f'{duration:10.1f} s {count:4d} {name}')
+
+
+@cli.group("cache")
+def cmd_cache():
+    '''
+    Save or restore images to or from a local image cache.
+    '''
+    pass
+
+
+def cache_options(func):
+    '''
+    Options shared by the cache commands.
+    '''
+    func = click.option("-C","--cache-dir", default=None,
+                        help="The image cache directory [default:~/.cache/winch/images]")(func)
+    func = click.option("--containerfile-attribute", default="containerfile",
+                        help="Name the attribute providing the Containerfile content")(func)
+    func = click.option("--image-attribute", default="image",
+                        help="Name the attribute providing the image name")(func)
+    return func
+
+
+def cached_inodes(ctx, inodes, containerfile_attribute, image_attribute):
+    '''
+    Yield (inode, image, containerfile) for the selected I-nodes that are built.
+    '''
+    for inode in inodes:
+        idata = ctx.obj.graph.data(inode)
+        if containerfile_attribute not in idata:
+            continue
+        yield inode, idata[image_attribute], idata[containerfile_attribute]
+
+
+@cmd_cache.command("save")
+@selection(none_is_all=True)
+@cache_options
+@click.pass_context
+def cmd_cache_save(ctx, inodes, cache_dir, containerfile_attribute, image_attribute):
+    '''
+    Save existing images of the selection to the image cache.
+    '''
+    cache_dir = cache_dir or cachedir("winch/images")
+    for inode, image, cfile in cached_inodes(ctx, inodes, containerfile_attribute, image_attribute):
+        if not image_exists(image):
+            debug(f'no image to cache: {image}')
+            continue
+        if cache.save(cache_dir, image, inode, cfile):
+            print(f'cached image: {image}')
+
+
+@cmd_cache.command("restore")
+@selection(none_is_all=True)
+@cache_options
+@click.pass_context
+def cmd_cache_restore(ctx, inodes, cache_dir, containerfile_attribute, image_attribute):
+    '''
+    Restore missing images of the selection from the image cache.
+    '''
+    cache_dir = cache_dir or cachedir("winch/images")
+    for inode, image, cfile in cached_inodes(ctx, inodes, containerfile_attribute, image_attribute):
+        if image_exists(image):
+            continue
+        if cache.restore(cache_dir, image, inode, cfile):
+            print(f'restored image from cache: {image}')
+
+
+def archive_path(archive_dir, image):
+    '''
+    Return path of an archive file to hold the image.
+    '''
+    safe = image.replace('/','_').replace(':','_')
+    return str(Path(archive_dir) / f'{safe}.tar')
+
+
+@cli.command("shard")
+@selection(none_is_all=True)
+@click.option("-n","--count", default=2, type=int,
+              help="Number of shards")
+@click.option("--containerfile-attribute", default="containerfile",
+              help="Name the attribute providing the Containerfile content")
+@click.option("--image-attribute", default="image",
+              help="Name the attribute providing the image name")
+@click.option("-o","--outdir", default="winch-shards",
+              help="Directory to receive shard manifest files")
+@click.option("-a","--archive-dir", default="winch-archives",
+              help="Directory to hold image archives passed between shards")
+@click.option("--history/--no-history", default=True,
+              help="Estimate build costs from the build history")
+@click.option("--history-db", default=None,
+              help="The build history database [default:~/.cache/winch/history.db]")
+@click.pass_context
+def shard(ctx, inodes, count, containerfile_attribute, image_attribute, outdir, archive_dir,
+          history, history_db):
+    '''
+    Partition the selection into shards of balanced build cost.
+
+    This writes "base.json" with shared I-nodes that must be built first and
+    "shard-N.json" for each shard.  Each is built with "winch build -m".
+
+    Root I-nodes without a Containerfile name base images that each shard pulls
+    as needed and so they are not passed between shards as archives.
+
+    The cost to build an I-node is its mean duration in the build history, if
+    recorded, else its "build_cost" attribute, if given.  Otherwise it is 0
+    for I-nodes without a Containerfile and for others the mean recorded
+    duration of their kind, or of all builds, or 1 if there is no history.
+    '''
+    gr = ctx.obj.graph
+    costs = History(history_db).costs() if history else None
+    cost = cost_function(gr, costs, containerfile_attribute, image_attribute)
+    shared, shards = partition(gr, list(inodes), count, cost)
+
+    def image_of(inode):
+        return gr.data(inode)[image_attribute]
+
+    def pulled(inode):
+        return containerfile_attribute not in gr.data(inode)
+
+    shared_set = set(shared)
+    needed = set()
+    shard_manifests = dict()
+    for num, members in enumerate(shards, start=1):
+        loads = list()
+        for inode in members:
+            parent = next(iter(gr.I.predecessors(inode)), None)
+            if parent in shared_set and parent not in loads and not pulled(parent):
+                loads.append(parent)
+        needed.update(loads)
+        shard_manifests[f'shard-{num}'] = dict(
+            cost = sum(cost(n) for n in members),
+            load = [archive_path(archive_dir, image_of(n)) for n in loads],
+            build = members,
+            save = dict())
+
+    base = dict(
+        cost = sum(cost(n) for n in shared),
+        load = [],
+        build = shared,
+        save = {image_of(n): archive_path(archive_dir, image_of(n))
+                for n in shared if n in needed and not pulled(n)})
+    manifests = dict(base=base, **shard_manifests)
+
+    outdir = Path(outdir)
+    for name, man in manifests.items():
+        man["images"] = [image_of(n) for n in man["build"]]
+        assure_file(outdir / f'{name}.json', json.dumps(man, indent=2))
+        print(f'{name}: {len(man["build"])} I-nodes with cost {man["cost"]}')
+
+
+def stale_images(local, current, prefixes, patterns=()):
+    '''
+    Return the local images that are stale.
+
+    The local is a list of image dicts as from podman.list_images().  An image
+    is stale if none of its names are in current.  If patterns are given, a
+    stale image must match one of the glob patterns.  Otherwise it must extend
+    one of the prefixes with a "-".
+    '''
+    ret = list()
+    for one in local:
+        names = [short_name(n) for n in one.get("Names") or []]
+        if not names or any(n in current for n in names):
+            continue
+        if patterns:
+            if not any(fnmatch.fnmatch(n, p) for n in names for p in patterns):
+                continue
+        elif not any(n.startswith(p + '-') for n in names for p in prefixes):
+            continue
+        ret.append(one)
+    return ret
+
+
+@cli.command("gc")
+@click.option("-p","--pattern", multiple=True,
+              help="Glob pattern for names of images to consider")
+@click.option("--containerfile-attribute", default="containerfile",
+              help="Name the attribute providing the Containerfile content")
+@click.option("--image-attribute", default="image",
+              help="Name the attribute providing the image name")
+@click.option("-n","--dry-run", is_flag=True, default=False,
+              help="List stale images but do not remove them")
+@click.option("-f","--force", is_flag=True, default=False,
+              help="Also remove stale images in use by containers")
+@click.pass_context
+def gc(ctx, pattern, containerfile_attribute, image_attribute, dry_run, force):
+    '''
+    Remove stale images that the configuration no longer produces.
+
+    Local images with names not produced by any I-node are considered.  By
+    default an image is stale only if its name extends the name of an image
+    winch builds (eg, an old variant).  Any -p/--pattern replaces this rule.
+
+    All stale images are removed with a single podman call.
+    '''
+    current = set()
+    prefixes = set()
+    for inode, idata in ctx.obj.graph.nodes():
+        image = idata.get(image_attribute)
+        if image is None:
+            continue
+        current.add(image)
+        if containerfile_attribute in idata:
+            prefixes.add(image)
+
+    stale = stale_images(list_images(), current, prefixes, pattern)
+    if not stale:
+        print('no stale images')
+        return
+
+    total = 0
+    names = list()
+    for one in sorted(stale, key=lambda i: -i.get("Size", 0)):
+        total += one.get("Size", 0)
+        names += one["Names"]
+        for name in one["Names"]:
+            print(f'{human_size(one.get("Size", 0)):>10} {short_name(name)}')
+    print(f'{human_size(total):>10} total in {len(stale)} stale images')
+    if dry_run:
+        return
+
+    got = remove_images(names, force)
+    inuse = [line for line in got.stderr.splitlines() if "in use by a container" in line]
+    for line in inuse:
+        warn(line)
+    if inuse:
+        warn(f'{len(inuse)} images in use by containers were not removed, use -f/--force to remove them too')
+    elif got.returncode:
+        raise click.ClickException(got.stderr.strip())
+
+
+def image_sizes(gr, inodes, image_attribute):
+    '''
+    Return list of dicts giving the size and layers of the images of the
+    I-nodes that exist locally, each attributed relative to its I-graph parent.
+
+    Two podman calls are made regardless of the number of I-nodes.
+    '''
+    wanted = dict()
+    for inode in inodes:
+        wanted[inode] = None
+        wanted.update(dict.fromkeys(gr.I.predecessors(inode)))
+
+    local = set()
+    for one in list_images():
+        local.update(short_name(n) for n in one.get("Names") or [])
+
+    images = {n: gr.data(n).get(image_attribute) for n in wanted}
+    existing = [n for n in wanted if images[n] in local]
+    info = dict(zip(existing, inspect_images([images[n] for n in existing])))
+
+    ret = list()
+    for inode in inodes:
+        if inode not in info:
+            continue
+        size = info[inode].get("Size", 0)
+        layers = len(info[inode].get("RootFS", {}).get("Layers") or [])
+        parent = next(iter(gr.I.predecessors(inode)), None)
+        psize = player = 0
+        if parent in info:
+            psize = info[parent].get("Size", 0)
+            player = len(info[parent].get("RootFS", {}).get("Layers") or [])
+        ret.append(dict(node=inode, image=images[inode], kind=gr.data(inode).get("kind"),
+                        size=size, layers=layers,
+                        added_size=size - psize, added_layers=layers - player))
+    ret.sort(key=lambda r: -r["added_size"])
+    return ret
+
+
+@cli.command("sizes")
+@selection(none_is_all=True)
+@click.option("--image-attribute", default="image",
+              help="Name the attribute providing the image name")
+@click.option("-F","--format", "fmt", default="table",
+              type=click.Choice(["table","json"]),
+              help="Output format")
+@click.pass_context
+def cmd_sizes(ctx, inodes, image_attribute, fmt):
+    '''
+    Report image sizes and layer counts and what each adds to its parent.
+
+    Images are sorted by the size they add and totals are given per kind.
+    Images that do not exist locally are omitted.
+    '''
+    sizes = image_sizes(ctx.obj.graph, list(inodes), image_attribute)
+    kinds = dict()
+    for one in sizes:
+        kinds[one["kind"]] = kinds.get(one["kind"], 0) + one["added_size"]
+
+    if fmt == "json":
+        print(json.dumps(dict(images=sizes, kinds=kinds), indent=2))
+        return
+
+    for one in sizes:
+        print(f'{human_size(one["added_size"]):>10} {human_size(one["size"]):>10} '
+              f'{one["added_layers"]:>4}/{one["layers"]:<4} {one["image"]}')
+    for kind, added in sorted(kinds.items(), key=lambda kv: -kv[1]):
+        print(f'{human_size(added):>10} total for kind {kind}')
+
+
+@cli.command("test")
+@selection(none_is_all=True)
+@click.option("-t","--template", default=None,
+              help="The template for the test command run in each image")
+@click.option("-T","--test-attribute", default="test",
+              help="Name the attribute providing the test command if no template")
+@click.option("--image-attribute", default="image",
+              help="Name the attribute providing the image name")
+@click.option("-j","--jobs", default=4, type=int,
+              help="Number of tests to run concurrently")
+@click.option("--timeout", default=None, type=float,
+              help="Seconds after which a test is stopped and fails")
+@click.option("-l","--logdir", default="winch-tests",
+              help="Directory to receive the output of each test")
+@click.option("-F","--format", "fmt", default="json",
+              type=click.Choice(["json","junit"]),
+              help="Format of the summary")
+@click.option("-o","--output", default="/dev/stdout",
+              help="Output for the summary")
+@click.pass_context
+def cmd_test(ctx, inodes, template, test_attribute, image_attribute, jobs, timeout, logdir, fmt, output):
+    '''
+    Run a test command in a container of each selected image.
+
+    The command is the -t/--template or else the -T/--test-attribute of each
+    I-node, formatted with the I-node attributes.  I-nodes with neither are
+    skipped.  The tests run concurrently and a summary of pass or fail is
+    written.  The exit code is non-zero if any test fails.
+    '''
+    gr = ctx.obj.graph
+    tests = list()
+    for inode in inodes:
+        idata = gr.data(inode)
+        text = template or idata.get(test_attribute)
+        if not text:
+            debug(f'no test for {inode}')
+            continue
+        text = text.replace('\\n','\n').replace('\\t','\t')
+        tests.append((idata[image_attribute], compile_template(text).render(idata, node=inode)))
+    if not tests:
+        warn('no tests to run')
+        return
+
+    results = run_tests(tests, jobs, timeout, logdir)
+    if fmt == "junit":
+        text = junit_xml(results)
+    else:
+        summary = [{k:v for k,v in r.items() if k != "output"} for r in results]
+        text = json.dumps(summary, indent=2) + '\n'
+    with open(output, "w") as out:
+        out.write(text)
+
+    failed = [r for r in results if r["status"] != "pass"]
+    for res in failed:
+        warn(f'test {res["status"]}: {res["image"]}')
+    if failed:
+        ctx.exit(1)
 
 
 @cli.command("render")
@@ -296,7 +1300,7 @@ def render(ctx, inodes, template, template_attribute, outpath):
 
     for inode in inodes:
         idata = ctx.obj.graph.data(inode)
-        opath = outpath.format_map(SafeDict(node=inode, **idata))
+        opath = compile_template(outpath).render(idata, node=inode)
         if template_attribute is not None:
             try:
                 tmpl = idata[template_attribute]
@@ -306,7 +1310,7 @@ def render(ctx, inodes, template, template_attribute, outpath):
         else:
             tmpl = template
         tmpl = tmpl.replace('\\n','\n').replace('\\t','\t')
-        otext = tmpl.format_map(SafeDict(node=inode, **idata))
+        otext = compile_template(tmpl).render(idata, node=inode)
         assure_file(opath, otext)
 
 
@@ -325,22 +1329,22 @@ def extract(image, output, path):
 
 
 @cli.command("dot")
+@selection(none_is_all=True)
 @click.option("-o","--output", default="/dev/stdout",
               help='Output for dot content')
 @click.option("-t","--template", default="{image}\n{node}",
               help="The template node label")
+@click.option("--cluster", is_flag=True, default=False,
+              help="Draw I-nodes of the same kind in a cluster")
 @click.pass_context
-def dot(ctx, output, template):
+def dot(ctx, inodes, output, template, cluster):
     '''
     Emit GraphViz dot representing the configured graph.
-    '''
-    I = ctx.obj.graph.I
-    for node, data in I.nodes.data():
-        label = template.format(ntype='I', node=node, **data)
-        I.nodes[node].clear()
-        I.nodes[node]["label"] = label
 
-    write_dot(I, output)
+    A selection limits the output to the subgraph of the selected I-nodes.
+    '''
+    write_dot(ctx.obj.graph.I, output, inodes, template,
+              cluster="kind" if cluster else None)
 
 
 
@@ -21,6 +21,22 @@ def basedir(name = None, assure = True):
     return path
 
 
+def cachedir(name = None, assure = True):
+    '''
+    Return a cache directory.
+
+    If name is given, it is included as a subdirectory.
+
+    If assure then the directory will be created if not yet existing.
+    '''
+    path = Path(os.environ.get('XDG_CACHE_HOME', os.environ['HOME'] + '/.cache'))
+    if name:
+        path /= name
+    if assure:
+        path.mkdir(exist_ok=True, parents=True)
+    return path
+
+
 def load(path=None):
     '''
     Load and parse configuration at path.  
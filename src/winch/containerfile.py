@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+'''
+Transformations of Containerfile text.
+'''
+import re
+import difflib
+
+
+def stage_name(num, kind):
+    '''
+    Return a valid build stage name for a layer.
+    '''
+    return re.sub(r'[^a-z0-9_.-]', '-', f'winch-{num}-{kind}'.lower())
+
+
+def is_from(line):
+    '''
+    Return True if line is a FROM instruction.
+    '''
+    words = line.split(None, 1)
+    return bool(words) and words[0].upper() == "FROM"
+
+
+def from_image(line):
+    '''
+    Return the image named by a FROM instruction line.
+    '''
+    return [w for w in line.split()[1:] if not w.startswith("--")][0]
+
+
+def rewrite_from(line, parent=None, base=None, alias=None):
+    '''
+    Return a FROM instruction line rewritten.
+
+    If the image is parent it is replaced by base.  If alias is given, it
+    replaces or adds the stage name.
+    '''
+    words = line.split()
+    opts = [w for w in words[1:] if w.startswith("--")]
+    rest = [w for w in words[1:] if not w.startswith("--")]
+    image, rest = rest[0], rest[1:]
+    if parent is not None and image == parent:
+        image = base
+    if alias:
+        if len(rest) >= 2 and rest[0].upper() == "AS":
+            rest = rest[2:]
+        rest = ["AS", alias] + rest
+    return ' '.join([words[0]] + opts + [image] + rest)
+
+
+def fuse(layers):
+    '''
+    Return text of one multi-stage Containerfile that builds a chain of layers.
+
+    The layers is a list of (stage, parent, text) for each layer in order from
+    the base.  The stage names the build stage of the layer, parent is the image
+    name the layer builds FROM and text is the layer's Containerfile.
+
+    The FROM of each layer after the first is rewritten to use the stage of the
+    previous layer and the last FROM of each layer is named by its stage.
+    '''
+    chunks = list()
+    prev = None
+    for stage, parent, text in layers:
+        lines = text.splitlines()
+        froms = [num for num, line in enumerate(lines) if is_from(line)]
+        if not froms:
+            raise ValueError(f'no FROM in Containerfile for stage {stage}')
+        if prev and not any(from_image(lines[n]) == parent for n in froms):
+            raise ValueError(f'no FROM {parent} in Containerfile for stage {stage}')
+        for num in froms:
+            alias = stage if num == froms[-1] else None
+            lines[num] = rewrite_from(lines[num], parent if prev else None, prev, alias)
+        chunks.append('\n'.join(lines).strip('\n'))
+        prev = stage
+    return '\n\n'.join(chunks) + '\n'
+
+
+directive_re = re.compile(r'^#\s*([a-zA-Z]+)\s*=\s*(\S+)\s*$')
+marker_re = re.compile(r'^#\s*winch:\s*(sort|end)\s*$')
+heredoc_re = re.compile(r'<<-?(["\']?)([a-zA-Z_][a-zA-Z0-9_]*)\1')
+
+
+def collapse(text, escape='\\'):
+    '''
+    Return text with each run of whitespace outside of quotes made one space.
+    '''
+    out = list()
+    quote = None
+    space = False
+    ind = 0
+    while ind < len(text):
+        char = text[ind]
+        if quote is None and char.isspace():
+            space = True
+            ind += 1
+            continue
+        if space and out:
+            out.append(' ')
+        space = False
+        if char == escape and quote != "'":
+            out.append(text[ind:ind+2])
+            ind += 2
+            continue
+        out.append(char)
+        if quote is None and char in '"\'':
+            quote = char
+        elif char == quote:
+            quote = None
+        ind += 1
+    return ''.join(out)
+
+
+def canonical(text):
+    '''
+    Return Containerfile text in a canonical form.
+
+    Equivalent Containerfiles that differ only in whitespace, line
+    continuations or comments give identical text.  Each instruction is put on
+    one line with its keyword in upper case.  As podman does, a continued line
+    is joined by removing the escape and newline and appending the next line
+    as it is.  Then runs of whitespace outside of quotes are made one space.
+    Comments and blank lines are removed.  Parser directives and the bodies of
+    here-documents are kept as they are.
+
+    Lines between a "# winch: sort" and a "# winch: end" comment are sorted.
+    Inside an instruction the words are sorted, such as those of a list of
+    packages.  Outside an instruction, whole instructions are sorted.
+    '''
+    escape = '\\'
+    out = list()
+    pieces = None               # of the current instruction
+    words = None                # to sort inside the current instruction
+    instructions = None         # to sort
+    closed = False              # words were sorted by the end of an instruction
+    directives = True
+    lines = iter(text.splitlines())
+    for raw in lines:
+        line = raw.strip()
+
+        if directives and pieces is None:
+            match = directive_re.match(line)
+            if match:
+                key, value = match.groups()
+                if key.lower() == "escape":
+                    escape = value
+                out.append(f'# {key.lower()}={value}')
+                continue
+            directives = False
+
+        if line.startswith('#'):
+            match = marker_re.match(line)
+            if not match:
+                continue
+            if match.group(1) == "sort":
+                if words is not None or instructions is not None:
+                    raise ValueError('nested "# winch: sort"')
+                if pieces is None:
+                    instructions = list()
+                else:
+                    words = list()
+            elif words is not None:
+                pieces.append(' ' + ' '.join(sorted(words)) + ' ')
+                words = None
+            elif instructions is not None:
+                out += sorted(instructions)
+                instructions = None
+            elif closed:
+                closed = False
+            else:
+                raise ValueError('"# winch: end" without "# winch: sort"')
+            continue
+        if not line:
+            continue
+
+        # Only the first line of an instruction loses its leading whitespace
+        # which may be inside of quotes on a continued line.
+        line = raw.rstrip() if pieces else line
+        continued = line.endswith(escape)
+        if continued:
+            line = line[:-len(escape)]
+        if words is not None:
+            words += line.split()
+        else:
+            pieces = (pieces or list()) + [line]
+        if continued:
+            continue
+
+        if words is not None:
+            pieces.append(' ' + ' '.join(sorted(words)) + ' ')
+            words = None
+            closed = True
+        first, _, rest = collapse(''.join(pieces), escape).strip().partition(' ')
+        inst = [f'{first.upper()} {rest}'.rstrip()]
+        pieces = None
+        # Here-document bodies follow the instruction and are kept verbatim.
+        for _, delim in heredoc_re.findall(inst[0]):
+            for body in lines:
+                inst.append(body)
+                if body.strip() == delim:
+                    break
+        inst = '\n'.join(inst)
+        if instructions is None:
+            out.append(inst)
+        else:
+            instructions.append(inst)
+
+    if pieces is not None or words is not None or instructions is not None:
+        raise ValueError('unterminated instruction or "# winch: sort" block')
+    return '\n'.join(out) + '\n'
+
+
+def explain(text, canon, name="Containerfile"):
+    '''
+    Return a unified diff of Containerfile text to its canonical form.
+    '''
+    return ''.join(difflib.unified_diff(text.splitlines(keepends=True),
+                                        canon.splitlines(keepends=True),
+                                        name, f'{name} (canonical)'))
@@ -36,6 +36,41 @@ parameters.
 
 from .util import debug, digest, outer_product, self_format, product
 import networkx as nx
+import heapq
+from itertools import chain
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+
+def _generate_partial(K, kindex, kpath, variants):
+    '''
+    Return the I-nodes generated along one K-graph path from the given
+    variants of its first K-nodes.
+
+    Each I-node is returned as (key, inode, idata, parent inode).  Sorting on
+    key gives the order in which the I-nodes are seen when the I-graph is
+    generated serially.
+    '''
+    gr = Graph()
+    gr.K = K
+    ret = list()
+    level = [((), None, None)]
+    for knum in range(len(kpath)):
+        adats = list(enumerate(gr._generate_adata(kpath[:knum+1])))
+        if knum < len(variants):
+            adats = [adats[variants[knum]]]
+        idats = list()
+        for (anum, adat), (pkey, ipnode, iparentdat) in product(adats, level):
+            key = (anum, pkey)
+            if iparentdat:
+                idat = self_format(dict(adat, parent=iparentdat))
+            else:
+                idat = self_format(dict(adat))
+            inode = digest(idat)
+            ret.append(((kindex, knum, key), inode, idat, ipnode))
+            idats.append((key, inode, idat))
+        level = idats
+    return ret
+
 
 class Graph:
 
@@ -106,6 +141,13 @@ class Graph:
         '''
         Initialize the graph with mapping from kind name to kind parameters.
         '''
+        self.set_kinds(**knodes)
+        self.generate()
+
+    def set_kinds(self, **knodes):
+        '''
+        Set the K-graph from mapping from kind name to kind parameters.
+        '''
         self.K = nx.DiGraph()
         for knode, kdata in knodes.items():
             self.K.add_node(knode, **kdata)
@@ -119,8 +161,60 @@ class Graph:
             for pk in pks:
                 self.K.add_edge(pk, knode)
 
+    def partitions(self, kpaths=None):
+        '''
+        Return list of (index, kpath, variants) partitioning the generation of
+        the I-graph.
+
+        Each K-graph path is split by the variants of its root K-node and of
+        the K-node following the root.
+        '''
+        if kpaths is None:
+            kpaths = self.kpaths()
+        parts = list()
+        for kindex, kpath in enumerate(kpaths):
+            counts = [range(len(self._generate_adata(kpath[:knum+1])))
+                      for knum in range(min(2, len(kpath)))]
+            for variants in product(*counts):
+                parts.append((kindex, kpath, variants))
+        return parts
+
+    def generate(self, nprocs=1):
+        '''
+        Generate the I-graph from the K-graph.
+
+        With nprocs more than one, the generation is split into partitions
+        which are generated by a pool of processes.  The I-nodes from all
+        partitions are merged in the order they are seen serially so that
+        the I-graph is identical to one generated serially.
+        '''
         self.I = nx.DiGraph()
-        for kpath in self.kpaths():
+        kpaths = self.kpaths()
+
+        parts = list()
+        if nprocs > 1:
+            parts = self.partitions(kpaths)
+        if len(parts) <= 1:
+            self._generate_kpaths(kpaths)
+            return
+
+        nprocs = min(nprocs, len(parts))
+        debug(f'generating {len(parts)} partitions with {nprocs} processes')
+        with ProcessPoolExecutor(nprocs) as pool:
+            got = pool.map(_generate_partial, [self.K]*len(parts), *zip(*parts),
+                           chunksize=max(1, len(parts) // (4*nprocs)))
+            found = sorted(chain.from_iterable(got), key=itemgetter(0))
+        for key, inode, idat, ipnode in found:
+            if inode not in self.I:
+                self.I.add_node(inode, **idat)
+            if ipnode:
+                self.I.add_edge(ipnode, inode)
+
+    def _generate_kpaths(self, kpaths):
+        '''
+        Add to the I-graph the I-nodes generated along K-graph paths.
+        '''
+        for kpath in kpaths:
             idats_on_path = list()
             for knum, knode in enumerate(kpath):
                 parent_idats = None
@@ -176,3 +270,78 @@ class Graph:
         ret.reverse()
         return ret
 
+
+    def schedule(self, inodes, cost):
+        '''
+        Return inodes ordered so that parents come first and, among those
+        ready to build, the one heading the longest critical path comes first.
+
+        The cost is a function of an I-node returning its estimated build cost.
+        '''
+        inodes = list(inodes)
+        index = {n:i for i,n in enumerate(inodes)}
+
+        def parent(inode):
+            for one in reversed(self.ipath(inode)[:-1]):
+                if one in index:
+                    return one
+            return None
+
+        children = {n: list() for n in inodes}
+        for inode in inodes:
+            p = parent(inode)
+            if p is not None:
+                children[p].append(inode)
+
+        # Longest cost path from an I-node down to a selected leaf.
+        rank = dict()
+        for inode in sorted(inodes, key=lambda n: -len(self.ipath(n))):
+            rank[inode] = cost(inode) + max((rank[c] for c in children[inode]), default=0)
+
+        ready = [(-rank[n], index[n], n) for n in inodes if parent(n) is None]
+        heapq.heapify(ready)
+        ret = list()
+        while ready:
+            _, _, inode = heapq.heappop(ready)
+            ret.append(inode)
+            for child in children[inode]:
+                heapq.heappush(ready, (-rank[child], index[child], child))
+        return ret
+
+
+def diff(old, new, key='image'):
+    '''
+    Return the change from old to new Graph as tuple (added, removed, modified).
+
+    I-nodes are matched by their digest and then by their key attribute.  The
+    added and modified are lists of I-nodes of new and removed are of old.  An
+    I-node with a key found in old but a different digest is modified as are
+    all I-nodes of new that descend from a modified or added I-node.
+    '''
+    old_keys = dict()
+    for inode, idata in old.nodes():
+        old_keys.setdefault(idata.get(key, inode), set()).add(inode)
+
+    new_keys = set()
+    added = list()
+    modified = dict()
+    for inode, idata in new.nodes():
+        ikey = idata.get(key, inode)
+        new_keys.add(ikey)
+        if inode in old.I:
+            continue
+        if ikey in old_keys:
+            modified[inode] = None
+        else:
+            added.append(inode)
+
+    for inode in added + list(modified):
+        for one in nx.descendants(new.I, inode):
+            if one not in added:
+                modified[one] = None
+    order = {n:i for i,n in enumerate(new.I.nodes)}
+    modified = sorted(modified, key=lambda n: order[n])
+
+    removed = [inode for inode, idata in old.nodes()
+               if inode not in new.I and idata.get(key, inode) not in new_keys]
+    return added, removed, modified
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+A persistent record of image builds.
+
+Each call to build an image is recorded in a local SQLite database with its
+duration, exit status and resulting image ID and size.  The records are keyed
+by I-node digest and image name so they may inform reports and the estimated
+cost of future builds.
+'''
+import time
+import sqlite3
+from pathlib import Path
+from statistics import mean
+
+from .config import cachedir
+
+schema = '''
+CREATE TABLE IF NOT EXISTS builds (
+    run TEXT,
+    inode TEXT,
+    image TEXT,
+    started REAL,
+    duration REAL,
+    status INTEGER,
+    image_id TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS builds_inode ON builds (inode);
+CREATE INDEX IF NOT EXISTS builds_image ON builds (image);
+'''
+
+
+class History:
+    '''
+    The build history database.
+
+    If path is not given, the database is in the winch cache directory.
+    '''
+    def __init__(self, path=None):
+        if path is None:
+            path = cachedir("winch") / "history.db"
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.run = time.strftime("%Y%m%dT%H%M%S")
+        self.db = sqlite3.connect(path)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, inode, image, started, duration, status, image_id=None, size=None):
+        '''
+        Record one build.
+        '''
+        with self.db:
+            self.db.execute('INSERT INTO builds VALUES (?,?,?,?,?,?,?,?)',
+                            (self.run, inode, image, started, duration, status, image_id, size))
+
+    def builds(self, image=None):
+        '''
+        Return list of build record dicts, oldest first, optionally for one image.
+        '''
+        sql = 'SELECT * FROM builds'
+        args = ()
+        if image:
+            sql += ' WHERE image = ?'
+            args = (image,)
+        cur = self.db.execute(sql + ' ORDER BY started', args)
+        names = [d[0] for d in cur.description]
+        return [dict(zip(names, row)) for row in cur]
+
+    def slowest(self, limit=10):
+        '''
+        Return list of (image, mean duration, number of builds) of the slowest
+        successfully built images.
+        '''
+        cur = self.db.execute('''
+        SELECT image, AVG(duration) AS mean, COUNT(*) FROM builds WHERE status = 0
+        GROUP BY image ORDER BY mean DESC LIMIT ?''', (limit,))
+        return cur.fetchall()
+
+    def regressions(self, factor=1.5):
+        '''
+        Return list of (image, latest duration, prior mean duration) for images
+        whose latest successful build took more than factor times the mean of
+        their prior successful builds.
+        '''
+        durations = dict()
+        for rec in self.builds():
+            if rec["status"] == 0:
+                durations.setdefault(rec["image"], list()).append(rec["duration"])
+        ret = list()
+        for image, durs in durations.items():
+            if len(durs) < 2:
+                continue
+            prior = mean(durs[:-1])
+            if durs[-1] > factor * prior:
+                ret.append((image, durs[-1], prior))
+        ret.sort(key=lambda r: r[2] - r[1])
+        return ret
+
+    def costs(self):
+        '''
+        Return mapping from I-node digest and from image name to the mean
+        duration of their successful builds.
+        '''
+        ret = dict()
+        for key in ("image", "inode"):
+            cur = self.db.execute(f'''
+            SELECT {key}, AVG(duration) FROM builds WHERE status = 0 GROUP BY {key}''')
+            ret.update(cur.fetchall())
+        return ret
@@ -24,8 +24,14 @@ Notes for podman usage:
   $ export TMPDIR=/path/to/big/disk/tmp
 
 '''
+import io
+import json
+import tarfile
+import tempfile
+import subprocess
 from pathlib import Path
-from .util import which, assure_file
+from concurrent.futures import ThreadPoolExecutor
+from .util import which, assure_file, debug
 
 def assure_context(containerfile, text=None, files=()):
     '''
@@ -49,15 +55,54 @@ def assure_context(containerfile, text=None, files=()):
 def pull_image(name):
     '''
     Pull named image.  Return hash.
+
+    Raises RuntimeError with the podman error output if the pull fails.
     '''
     podman = which("podman")
-    out = podman(['pull', name], capture_output=True)
+    out = podman(['pull', name], check=False, capture_output=True)
     if out.returncode:
-        raise RuntimeError(out.stderr)
+        raise RuntimeError(out.stderr.decode().strip())
     return out.stdout.decode().strip()
 
     
 
+class Prefetch:
+    '''
+    Pull images concurrently in the background.
+
+    >>> pulls = Prefetch(["debian:bookworm", "almalinux:9"], jobs=2)
+    >>> pulls.wait("debian:bookworm")
+    >>> pulls.shutdown()
+    '''
+    def __init__(self, names, jobs=4):
+        self.futures = dict()
+        self.pool = None
+        names = list(dict.fromkeys(names))
+        if not names:
+            return
+        self.pool = ThreadPoolExecutor(max(1, jobs))
+        for name in names:
+            debug(f'prefetching {name}')
+            self.futures[name] = self.pool.submit(pull_image, name)
+
+    def wait(self, name):
+        '''
+        Wait for the named image to be pulled, if it is being pulled.
+
+        Raises the error of a failed pull.
+        '''
+        future = self.futures.get(name)
+        if future is not None:
+            return future.result()
+
+    def shutdown(self):
+        '''
+        Wait for all pulls to finish.
+        '''
+        if self.pool:
+            self.pool.shutdown()
+
+
 def remove_image(name):
     '''
     Remove named image if it exists
@@ -71,6 +116,56 @@ def remove_image(name):
     return podman(["image","rm",name])
 
 
+def remove_images(names, force=False):
+    '''
+    Remove many named images with one podman call.
+
+    If force is True, containers using the images are also removed.
+
+    Return the completed process which is not checked for errors.
+    '''
+    args = ["rmi"]
+    if force:
+        args.append("--force")
+    podman = which("podman")
+    return podman(args + list(names), check=False, capture_output=True, text=True)
+
+
+def list_images():
+    '''
+    Return list of dicts describing all local images.
+    '''
+    podman = which("podman")
+    got = podman(["images", "--format", "json"], capture_output=True)
+    return json.loads(got.stdout.decode() or "[]")
+
+
+def inspect_images(names):
+    '''
+    Return list of dicts describing the named images with one podman call.
+
+    All names must be of existing images.
+    '''
+    if not names:
+        return []
+    podman = which("podman")
+    got = podman(["image", "inspect"] + list(names), capture_output=True)
+    return json.loads(got.stdout.decode() or "[]")
+
+
+def short_name(name):
+    '''
+    Return image name without the default registry and tag added by podman.
+    '''
+    for prefix in ("localhost/", "docker.io/library/"):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+            break
+    if name.endswith(":latest"):
+        name = name[:-len(":latest")]
+    return name
+
+
 def build_image(name, containerfile, *args):
     '''
     Build from containerfile with given name.
@@ -83,6 +178,89 @@ def build_image(name, containerfile, *args):
     return podman(["build"] + list(args) + ["-t", name, context])
 
 
+def save_image(name, archive, format="oci-archive"):
+    '''
+    Save named image to an archive file.
+    '''
+    Path(archive).parent.mkdir(parents=True, exist_ok=True)
+    podman = which("podman")
+    return podman(["save", "--format", format, "-o", str(archive), name])
+
+
+def load_image(archive):
+    '''
+    Load image(s) from an archive file.
+    '''
+    podman = which("podman")
+    return podman(["load", "-i", str(archive)])
+
+
+def context_tar(files):
+    '''
+    Return bytes of a tar archive holding files.
+
+    The files maps a relative path to its text content.  The archive is made
+    reproducible so that equal files give equal bytes.
+    '''
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for path, text in sorted(files.items()):
+            data = text.encode()
+            info = tarfile.TarInfo(str(path))
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def build_image_stream(name, files, *args):
+    '''
+    Build from an in-memory context with given name.
+
+    The files maps relative paths to text content and must include a
+    "Containerfile".  The context is sent to "podman build" as a tar archive on
+    its standard input so nothing is written to the filesystem.  Any args will
+    be passed to "podman build".
+    '''
+    podman = which("podman")
+    return podman(["build"] + list(args) + ["-t", name, "-"], input=context_tar(files))
+
+
+def push_image(name, dest, *args):
+    '''
+    Push named image to destination dest.
+
+    Any args will be passed to "podman push".  Return the digest of the pushed
+    manifest.
+    '''
+    podman = which("podman")
+    with tempfile.TemporaryDirectory(prefix="winch-push-") as tmpdir:
+        digestfile = Path(tmpdir) / "digest"
+        podman(["push", "--digestfile", str(digestfile)] + list(args) + [name, dest])
+        return digestfile.read_text().strip()
+
+
+def remote_digest(dest, tls_verify=True):
+    '''
+    Return the manifest digest of image dest in a registry.
+
+    Return None if the image is not in the registry or if skopeo, which is used
+    to inspect it without pulling, is not installed.
+    '''
+    try:
+        skopeo = which("skopeo")
+    except FileNotFoundError:
+        debug('skopeo not found, can not check remote digests')
+        return None
+    args = ["inspect", "--format", "{{.Digest}}"]
+    if not tls_verify:
+        args.append("--tls-verify=false")
+    got = skopeo(args + [f'docker://{dest}'], check=False, capture_output=True, text=True)
+    if got.returncode:
+        return None
+    return got.stdout.strip() or None
+
+
 def image_exists(name):
     '''
     Return True only if image exists.
@@ -107,6 +285,27 @@ def create_container(image, name=None):
     return got.stdout.decode().strip()
 
 
+def run_container(image, command, name=None, timeout=None):
+    '''
+    Run a shell command in a new container from image and remove it after.
+
+    Return the completed process, with output captured, without checking
+    for errors.  On timeout the container is removed and TimeoutExpired is
+    raised.
+    '''
+    args = ['run', '--rm']
+    if name:
+        args += ['--name', name]
+    args += [image, 'sh', '-c', command]
+    podman = which("podman")
+    try:
+        return podman(args, check=False, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        if name:
+            podman(["rm", "--force", name], check=False, capture_output=True)
+        raise
+
+
 def remove_container(cid):
     '''
     Remove a contain by a container ID or name.
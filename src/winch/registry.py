@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+'''
+Push images to a registry.
+
+Images are pushed concurrently but in I-graph order so that a parent image is
+in the registry before any of its children.  A push is skipped when the
+registry already holds the manifest that was last pushed from an unchanged
+local image.  The local image has no manifest digest of its own until it is
+pushed and so a record of past pushes is kept in the winch cache directory.
+'''
+import json
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import debug
+from .util import template as compile_template
+from .config import cachedir
+from .podman import push_image, remote_digest, inspect_images
+from .shard import topological
+
+
+def destination(template, idata, image_attribute="image", **extra):
+    '''
+    Return the registry destination of an image.
+
+    The template is formatted with the I-node attributes.  If it has no
+    format markup it is taken as a prefix to the image name.
+    '''
+    if '{' not in template:
+        return f'{template.rstrip("/")}/{idata[image_attribute]}'
+    return compile_template(template).render(idata, **extra)
+
+
+class PushRecord:
+    '''
+    The record of past pushes mapping destination to local image ID and
+    pushed digest.
+
+    If path is not given, the record is in the winch cache directory.
+    '''
+    def __init__(self, path=None):
+        if path is None:
+            path = cachedir("winch") / "pushed.json"
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.pushed = dict()
+        if self.path.exists():
+            self.pushed = json.loads(self.path.read_text())
+
+    def get(self, dest):
+        return self.pushed.get(dest, dict())
+
+    def set(self, dest, image_id, digest):
+        with self.lock:
+            self.pushed[dest] = dict(image_id=image_id, digest=digest)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(self.pushed, indent=2))
+
+
+def push_one(image, dest, image_id, record, tls_verify=True, force=False, args=()):
+    '''
+    Push one image to dest unless the registry already has it.
+
+    Return a result dict.  The status is "pushed", "present" or "failed".
+    '''
+    result = dict(image=image, dest=dest, image_id=image_id)
+    last = record.get(dest)
+    if not force and last.get("image_id") == image_id:
+        digest = remote_digest(dest, tls_verify)
+        if digest and digest == last.get("digest"):
+            debug(f'push skipped, {dest} has {digest}')
+            return dict(result, status="present", digest=digest)
+    if not tls_verify:
+        args = ["--tls-verify=false"] + list(args)
+    try:
+        digest = push_image(image, dest, *args)
+    except subprocess.CalledProcessError as err:
+        return dict(result, status="failed", error=str(err))
+    record.set(dest, image_id, digest)
+    debug(f'pushed {image} to {dest} as {digest}')
+    return dict(result, status="pushed", digest=digest)
+
+
+def push_many(graph, pushes, record, jobs=4, tls_verify=True, force=False, args=()):
+    '''
+    Push images concurrently, each after the push of its parent.
+
+    The pushes is a list of (inode, image, dest) of existing images.  The
+    parent of an I-node is its nearest ancestor with a push.  An image whose
+    parent push failed is not pushed and its status is "blocked".
+
+    Return list of result dicts in parent-first order.
+    '''
+    byinode = {inode: (image, dest) for inode, image, dest in pushes}
+    order = topological(graph, byinode)
+    images = list(dict.fromkeys(image for image, _ in byinode.values()))
+    image_ids = {image: info["Id"] for image, info in zip(images, inspect_images(images))}
+    futures = dict()
+
+    def parent_of(inode):
+        for one in reversed(graph.ipath(inode)[:-1]):
+            if one in byinode:
+                return one
+
+    def task(inode):
+        image, dest = byinode[inode]
+        parent = parent_of(inode)
+        if parent is not None and futures[parent].result()["status"] in ("failed", "blocked"):
+            return dict(image=image, dest=dest, status="blocked")
+        return push_one(image, dest, image_ids[image], record, tls_verify, force, args)
+
+    # Parents are submitted first so a task only waits on tasks already started.
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        for inode in order:
+            futures[inode] = pool.submit(task, inode)
+    return [futures[inode].result() for inode in order]
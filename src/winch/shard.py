@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+'''
+Partition a selection of I-nodes into shards of roughly equal build cost.
+
+A shard is a set of I-graph subtrees that may be built independently of other
+shards.  I-nodes that are ancestors to more than one shard are "shared" and
+must be built before any shard.  Their images are handed to the dependent
+shards as archive files.
+'''
+
+from statistics import mean
+
+from .util import debug
+
+
+def default_costs(graph, costs, containerfile_attribute="containerfile",
+                  image_attribute="image"):
+    '''
+    Return mapping from kind to the mean of the costs of its I-nodes.
+
+    The costs maps I-node or image name to cost as from History.costs().  The
+    key None gives the mean of all costs.  This estimates the cost of an
+    I-node that has not been built in units of the known costs.
+    '''
+    bykind = dict()
+    for inode in graph.I.nodes:
+        idata = graph.data(inode)
+        if containerfile_attribute not in idata:
+            continue
+        for key in (inode, idata.get(image_attribute)):
+            if key in costs:
+                bykind.setdefault(idata.get("kind"), list()).append(float(costs[key]))
+                break
+    ret = {kind: mean(vals) for kind, vals in bykind.items()}
+    known = [v for vals in bykind.values() for v in vals] or [float(c) for c in costs.values()]
+    if known:
+        ret[None] = mean(known)
+    return ret
+
+
+def node_cost(graph, inode, costs=None, containerfile_attribute="containerfile",
+              image_attribute="image", defaults=None):
+    '''
+    Return the estimated cost to build an I-node.
+
+    A cost found in costs (mapping from I-node or image name to cost, such as
+    from History.costs()) is used first, then a "build_cost" attribute of the
+    I-node.  An I-node without a Containerfile costs 0.  Otherwise the cost
+    is that of its kind in defaults (as from default_costs()), else that of
+    all kinds in defaults, else 1.
+    '''
+    idata = graph.data(inode)
+    if costs:
+        for key in (inode, idata.get(image_attribute)):
+            if key in costs:
+                return float(costs[key])
+    if "build_cost" in idata:
+        return float(idata["build_cost"])
+    if containerfile_attribute not in idata:
+        return 0.0
+    if defaults:
+        for key in (idata.get("kind"), None):
+            if key in defaults:
+                return defaults[key]
+    return 1.0
+
+
+def topological(graph, inodes):
+    '''
+    Return inodes ordered so that every parent precedes its children.
+
+    The original order is otherwise kept.
+    '''
+    inodes = list(inodes)
+    index = {n:i for i,n in enumerate(inodes)}
+    return sorted(inodes, key=lambda n: (len(graph.ipath(n)), index[n]))
+
+
+def _binpack(units, weight, count):
+    '''
+    Assign units to count bins, heaviest first to the lightest bin.
+
+    Return list of (load, list of units).
+    '''
+    bins = [[0.0, list()] for _ in range(count)]
+    for unit in sorted(units, key=lambda u: -weight[u]):
+        lightest = min(bins, key=lambda b: b[0])
+        lightest[0] += weight[unit]
+        lightest[1].append(unit)
+    return bins
+
+
+def partition(graph, inodes, count, cost):
+    '''
+    Partition the selected inodes into shared I-nodes and count shards.
+
+    The cost is a function of an I-node returning its estimated build cost.
+
+    Return tuple (shared, shards) with shared a list of selected I-nodes to be
+    built before any shard and shards a list of count lists of selected
+    I-nodes.  All lists are in topological order and some shards may be empty.
+    '''
+    if count < 1:
+        raise ValueError(f'shard count must be positive, got {count}')
+
+    selected = set(inodes)
+
+    # All I-nodes needed to connect the selection, in generation order.
+    closure = dict()
+    for inode in inodes:
+        for one in graph.ipath(inode):
+            closure[one] = None
+
+    def children(inode):
+        return [c for c in graph.I.successors(inode) if c in closure]
+
+    own = {n: (cost(n) if n in selected else 0.0) for n in closure}
+    weight = dict()
+    for inode in reversed(topological(graph, closure)):
+        weight[inode] = own[inode] + sum(weight[c] for c in children(inode))
+
+    def makespan(units, shared):
+        bins = _binpack(units, weight, count)
+        return sum(own[n] for n in shared) + max(b[0] for b in bins)
+
+    def chain(unit):
+        '''
+        Return the I-nodes from unit down to the first with other than one child.
+        '''
+        ret = [unit]
+        while len(children(ret[-1])) == 1:
+            ret.append(children(ret[-1])[0])
+        return ret
+
+    # Start with whole trees and split a subtree, moving its top I-nodes down
+    # to the next branch to the shared set.  Splitting a chain at each of its
+    # I-nodes would not change the total build and so would stall the search.
+    # The split giving the shortest total build is taken while it shortens
+    # the build or while some shard would be empty.  As a split may only pay
+    # off after another, the best partition seen is kept.
+    units = [n for n in closure if graph.I.in_degree(n) == 0]
+    shared = list()
+    best = None
+    while True:
+        current = makespan(units, shared)
+        score = (current, -min(len(units), count))
+        if best is None or score < best[0]:
+            best = (score, units, shared)
+        trials = list()
+        for unit in units:
+            top = chain(unit)
+            kids = children(top[-1])
+            if kids:
+                trial_units = [u for u in units if u != unit] + kids
+                trials.append((makespan(trial_units, shared + top), -weight[unit],
+                               unit, top, trial_units))
+        if not trials:
+            break
+        trial, _, unit, top, trial_units = min(trials, key=lambda t: t[:2])
+        if trial >= current and len(units) >= count:
+            break
+        debug(f'shard split {unit} with weight {weight[unit]}')
+        units = trial_units
+        shared = shared + top
+    _, units, shared = best
+
+    shards = list()
+    for load, bunits in _binpack(units, weight, count):
+        members = list()
+        for unit in bunits:
+            todo = [unit]
+            while todo:
+                one = todo.pop()
+                if one in selected:
+                    members.append(one)
+                todo += children(one)
+        shards.append(topological(graph, members))
+
+    shared = topological(graph, [n for n in shared if n in selected])
+    return shared, shards
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+Run test commands in containers made from winch images.
+'''
+import time
+import uuid
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import quoteattr, escape
+
+from .util import debug, assure_file
+from .podman import run_container
+
+
+def _text(out):
+    '''
+    Return captured output as text.
+    '''
+    if out is None:
+        return ''
+    if isinstance(out, bytes):
+        return out.decode(errors='replace')
+    return out
+
+
+def run_one(image, command, timeout=None, logdir=None):
+    '''
+    Run one test command in a container from image.
+
+    Return a result dict.  The status is "pass", "fail" or "timeout".
+    '''
+    name = f'winch-test-{uuid.uuid4().hex[:12]}'
+    result = dict(image=image, command=command, returncode=None)
+    started = time.time()
+    try:
+        got = run_container(image, command, name=name, timeout=timeout)
+        result["returncode"] = got.returncode
+        result["status"] = "pass" if got.returncode == 0 else "fail"
+        output = got.stdout + got.stderr
+    except subprocess.TimeoutExpired as err:
+        result["status"] = "timeout"
+        output = _text(err.stdout) + _text(err.stderr)
+    result["duration"] = time.time() - started
+    result["output"] = output
+    if logdir:
+        safe = image.replace('/','_').replace(':','_')
+        result["log"] = str(Path(logdir) / f'{safe}.log')
+        assure_file(result["log"], f'$ {command}\n{output}')
+    debug(f'test {result["status"]}: {image}')
+    return result
+
+
+def run_tests(tests, jobs=4, timeout=None, logdir=None):
+    '''
+    Run (image, command) tests concurrently, at most jobs at a time.
+
+    Return list of result dicts in the order of tests.
+    '''
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        futures = [pool.submit(run_one, image, command, timeout, logdir)
+                   for image, command in tests]
+        return [f.result() for f in futures]
+
+
+def junit_xml(results, name="winch"):
+    '''
+    Return JUnit XML text summarizing test results.
+    '''
+    failures = sum(1 for r in results if r["status"] != "pass")
+    total = sum(r["duration"] for r in results)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             f'<testsuite name={quoteattr(name)} tests="{len(results)}" '
+             f'failures="{failures}" time="{total:.3f}">']
+    for res in results:
+        lines.append(f'  <testcase classname={quoteattr(name)} name={quoteattr(res["image"])} '
+                     f'time="{res["duration"]:.3f}">')
+        if res["status"] != "pass":
+            message = f'{res["status"]} with return code {res["returncode"]}'
+            lines.append(f'    <failure message={quoteattr(message)}>{escape(res["command"])}</failure>')
+        lines.append(f'    <system-out>{escape(res["output"])}</system-out>')
+        lines.append('  </testcase>')
+    lines.append('</testsuite>')
+    return '\n'.join(lines) + '\n'
@@ -2,9 +2,12 @@
 import os
 import sys
 import json
+import re
 import shutil
 import logging
+import string
 import hashlib
+import functools
 from itertools import product
 import subprocess
 import tempfile
@@ -80,6 +83,114 @@ class SafeDict(dict):
         # print(f'MISSING: {key=}')
         return '{' + key + '}'
 
+_attr_re = re.compile(r'\.([^.[]+)')
+
+
+def split_field_name(field):
+    '''
+    Return (first, rest) for a str.format() field name.
+
+    The rest is a tuple of (is_attr, key) for each following ".attr" or
+    "[key]" as str.format() resolves them.  Digit keys are made integers.
+    '''
+    first = re.match(r'[^.[]*', field).group()
+    pos = len(first)
+    rest = list()
+    while pos < len(field):
+        if field[pos] == '.':
+            match = _attr_re.match(field, pos)
+            if not match:
+                raise ValueError(f'empty attribute in format field: {field}')
+            rest.append((True, match.group(1)))
+            pos = match.end()
+            continue
+        end = field.find(']', pos)
+        if field[pos] != '[' or end < 0:
+            raise ValueError(f'malformed format field: {field}')
+        key = field[pos+1:end]
+        rest.append((False, int(key) if key.isdigit() else key))
+        pos = end + 1
+    if first.isdigit():
+        first = int(first)
+    return first, tuple(rest)
+
+
+class Template:
+    '''
+    A str.format() template that is parsed once and rendered many times.
+
+    Rendering resolves fields directly against a mapping without copying it.
+    As with format_map(SafeDict(...)), a field naming a key missing from the
+    mapping is passed through as its original markup.
+
+    >>> Template("{image} {node}").render(idata, node=inode)
+    '''
+    def __init__(self, text):
+        self.text = text
+        self._segments = list()
+        for literal, field, spec, conv in string.Formatter().parse(text):
+            if literal:
+                self._segments.append(literal)
+            if field is None:
+                continue
+            markup = '{' + field
+            if conv:
+                markup += '!' + conv
+            if spec:
+                markup += ':' + spec
+            markup += '}'
+            first, rest = split_field_name(field)
+            if spec and '{' in spec:
+                spec = Template(spec)
+            self._segments.append((first, rest, conv, spec, markup))
+
+    def render(self, data, **extra):
+        '''
+        Return the template rendered with values from extra or data.
+        '''
+        parts = list()
+        for seg in self._segments:
+            if isinstance(seg, str):
+                parts.append(seg)
+                continue
+            first, rest, conv, spec, markup = seg
+            if first in extra:
+                obj = extra[first]
+            else:
+                try:
+                    obj = data[first]
+                except (KeyError, TypeError):
+                    parts.append(markup)
+                    continue
+            for is_attr, key in rest:
+                obj = getattr(obj, key) if is_attr else obj[key]
+            if conv == 'r':
+                obj = repr(obj)
+            elif conv == 's':
+                obj = str(obj)
+            elif conv == 'a':
+                obj = ascii(obj)
+            if isinstance(spec, Template):
+                spec = spec.render(data, **extra)
+            parts.append(format(obj, spec or ''))
+        return ''.join(parts)
+
+    def render_many(self, items, **extra):
+        '''
+        Yield the template rendered for each (node, data) pair in items.
+        '''
+        for node, data in items:
+            yield self.render(data, node=node, **extra)
+
+
+@functools.lru_cache(maxsize=1024)
+def template(text):
+    '''
+    Return a Template for text, reusing one previously parsed.
+    '''
+    return Template(text)
+
+
 def self_format(dat: dict, return_changed=False, ignore_errors = False) -> dict:
     '''
     Format string values in dict dat using keys in same dict.
@@ -267,6 +378,20 @@ def assure_file(path, content=None):
     path.write_text(content)
     
 
+def human_size(nbytes):
+    '''
+    Return a short human readable string for a number of bytes.
+    '''
+    size = float(nbytes)
+    for unit in ("B", "kB", "MB", "GB", "TB"):
+        if abs(size) < 1000 or unit == "TB":
+            break
+        size /= 1000
+    if unit == "B":
+        return f'{int(size)} B'
+    return f'{size:.1f} {unit}'
+
+
 def looks_like_digest(thing):
     if not isinstance(thing, str):
         return False
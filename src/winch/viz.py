@@ -1,3 +1,56 @@
 #!/usr/bin/env python
-# from networkx.drawing.nx_agraph import write_dot
-from networkx.drawing.nx_pydot import write_dot
+'''
+Visualize winch graphs.
+'''
+from .util import template as compile_template
+
+
+def quote(text):
+    '''
+    Return text as a quoted GraphViz dot ID.
+    '''
+    text = str(text).replace('\\', '\\\\')
+    return '"' + text.replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+def write_dot(graph, output, nodes=None, template="{node}", cluster=None):
+    '''
+    Write GraphViz dot for a networkx graph to the output path.
+
+    The graph is not modified.  If nodes is given, only the subgraph they
+    induce is written.  Each node label is the template rendered against the
+    node data.  If cluster names a node attribute, nodes sharing its value are
+    drawn in a cluster.
+    '''
+    if nodes is None:
+        nodes = graph.nodes
+    nodes = dict.fromkeys(nodes)
+    tmpl = compile_template(template)
+
+    with open(output, "w") as out:
+        out.write("digraph winch {\n")
+
+        groups = {None: list(nodes)}
+        if cluster:
+            groups = dict()
+            for node in nodes:
+                groups.setdefault(graph.nodes[node].get(cluster), list()).append(node)
+
+        for name, members in groups.items():
+            indent = "  "
+            if name is not None:
+                out.write(f'  subgraph {quote("cluster_" + str(name))} {{\n')
+                out.write(f'    label={quote(name)};\n')
+                indent = "    "
+            for node in members:
+                label = tmpl.render(graph.nodes[node], ntype='I', node=node)
+                out.write(f'{indent}{quote(node)} [label={quote(label)}];\n')
+            if name is not None:
+                out.write("  }\n")
+
+        for node in nodes:
+            for child in graph.successors(node):
+                if child in nodes:
+                    out.write(f'  {quote(node)} -> {quote(child)};\n')
+
+        out.write("}\n")
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+'''
+Benchmark the orchestration overhead of winch using the stub podman.
+
+A synthetic configuration is generated and winch commands are run on all of
+its instances with the stub podman from tests/stub/ first in PATH.  The stub
+may simulate podman latency and failures.  For example:
+
+  $ PYTHONPATH=src python tests/bench_orchestration.py --variants 10,10,10 --latency 0.01
+
+The result is printed as JSON.  The "overhead" is the time per instance not
+accounted for by the podman calls, each taking the simulated latency plus the
+time to start the stub which is measured first.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from winch.cli import cli
+
+stub_bin = Path(__file__).parent / "stub"
+
+
+def synthetic_config(path, roots=2, variants=(4, 4)):
+    '''
+    Write a configuration with a chain of kinds, each with a number of
+    variants, on a root kind with roots variants.  Return the number of
+    instances.
+    '''
+    lines = ['[root]',
+             f'release = {json.dumps([f"r{n}" for n in range(roots)])}',
+             "image = 'root:{release}'", '']
+    parent = "root"
+    count = total = roots
+    for num, nvar in enumerate(variants):
+        kind = f'layer{num}'
+        lines += [f'[{kind}]',
+                  f'parent_kind = "{parent}"',
+                  f'v{num} = {json.dumps([f"{kind}v{n}" for n in range(nvar)])}',
+                  f"image = '{{parent[image]}}-{{v{num}}}'",
+                  f"containerfile = '''\nFROM {{parent[image]}}\nRUN echo {{v{num}}}\nCOPY note.txt /\n'''",
+                  f"files = {{ 'note.txt' = '{{image}} from {{parent[image]}}' }}",
+                  '']
+        parent = kind
+        count *= nvar
+        total += count
+    Path(path).write_text('\n'.join(lines))
+    return total
+
+
+def stub_environ(stub_dir, latency=0, failure=0, seed=None):
+    '''
+    Return environment settings for using the stub podman.
+    '''
+    env = dict(PATH=f'{stub_bin}:{os.environ["PATH"]}',
+               PODMAN_STUB_DIR=str(stub_dir),
+               PODMAN_STUB_LATENCY=str(latency),
+               PODMAN_STUB_FAILURE=str(failure),
+               XDG_CACHE_HOME=str(Path(stub_dir) / "cache"),
+               WINCH_CONFIG=None)
+    if seed is not None:
+        env["PODMAN_STUB_SEED"] = str(seed)
+    return env
+
+
+def podman_calls(stub_dir):
+    logfile = Path(stub_dir) / "calls.jsonl"
+    if not logfile.exists():
+        return 0
+    return len(logfile.read_text().splitlines())
+
+
+def stub_call_time(stub_dir, count=10):
+    '''
+    Return the mean seconds to run the stub podman without latency.
+    '''
+    env = dict(os.environ, PODMAN_STUB_DIR=str(stub_dir))
+    start = time.perf_counter()
+    for _ in range(count):
+        subprocess.run([str(stub_bin / "podman"), "image", "exists", "none"], env=env)
+    return (time.perf_counter() - start) / count
+
+
+@contextlib.contextmanager
+def quiet():
+    '''
+    Discard output that podman writes directly to the stdout file descriptor.
+    '''
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, "w") as null:
+        os.dup2(null.fileno(), 1)
+    try:
+        yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def measure(runner, env, stub_dir, argses, ninstances, call_time):
+    '''
+    Run winch once for each args in argses and return a dict of measurements.
+    '''
+    before = podman_calls(stub_dir)
+    failed = 0
+    start = time.perf_counter()
+    with quiet():
+        for args in argses:
+            got = runner.invoke(cli, args, env=env)
+            failed += got.exit_code != 0
+    seconds = time.perf_counter() - start
+    calls = podman_calls(stub_dir) - before
+    return dict(failed=failed, seconds=seconds, instances=ninstances,
+                podman_calls=calls,
+                per_instance_ms=1000*seconds/max(1, ninstances),
+                overhead_ms=1000*(seconds - calls*call_time)/max(1, ninstances))
+
+
+def bench(workdir, roots=2, variants=(4, 4), latency=0.0, failure=0.0, seed=None, nextract=10):
+    '''
+    Run the benchmark in workdir and return dict of results by command.
+    '''
+    workdir = Path(workdir)
+    config = str(workdir / "bench.toml")
+    ninstances = synthetic_config(config, roots, variants)
+    stub_dir = workdir / "podman"
+    env = stub_environ(stub_dir, latency, failure, seed)
+    call_time = stub_call_time(workdir / "calibrate") + latency
+    runner = CliRunner()
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = dict(stub_call_ms=1000*call_time)
+        results["build"] = measure(runner, env, stub_dir, [[
+            "-c", config, "build", "-i", "all",
+            "-o", str(workdir / "contexts/{image}/Containerfile")]],
+                                   ninstances, call_time)
+        results["render"] = measure(runner, env, stub_dir, [[
+            "-c", config, "render", "-i", "all", "-T", "containerfile",
+            "-o", str(workdir / "render/{image}.txt")]],
+                                    ninstances, call_time)
+
+        imgfile = stub_dir / "images.json"
+        images = json.loads(imgfile.read_text()) if imgfile.exists() else {}
+        built = [i for i in images if "-" in i][:nextract]
+        (workdir / "extract").mkdir(exist_ok=True)
+        results["extract"] = measure(runner, env, stub_dir, [
+            ["-c", config, "extract", "-i", image, "-o", str(workdir / "extract"), "/note.txt"]
+            for image in built], len(built), call_time)
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument("--roots", type=int, default=2,
+                        help="Number of root variants")
+    parser.add_argument("--variants", default="4,4",
+                        help="Comma-separated number of variants of each layer kind")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Simulated podman latency in seconds")
+    parser.add_argument("--failure", type=float, default=0.0,
+                        help="Simulated podman failure probability")
+    parser.add_argument("--seed", default=None,
+                        help="Seed for simulated failures")
+    parser.add_argument("--extract", type=int, default=10,
+                        help="Number of images to extract from")
+    args = parser.parse_args(argv)
+    variants = [int(v) for v in args.variants.split(",")]
+    with tempfile.TemporaryDirectory(prefix="winch-bench-") as workdir:
+        results = bench(workdir, args.roots, variants, args.latency, args.failure,
+                        args.seed, args.extract)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
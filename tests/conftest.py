@@ -0,0 +1,64 @@
+'''
+Shared fixtures for winch tests.
+'''
+import os
+import json
+from pathlib import Path
+
+import pytest
+
+stub_bin = Path(__file__).parent / "stub"
+example_dir = Path(__file__).parent.parent / "example"
+
+
+class StubPodman:
+    '''
+    Access to the state of the stub podman found in tests/stub/.
+    '''
+    def __init__(self, path, monkeypatch):
+        self.path = path
+        self.monkeypatch = monkeypatch
+
+    def configure(self, latency=None, failure=None, seed=None):
+        '''
+        Set simulated latency and failure rate, see tests/stub/podman.
+        '''
+        for name, value in (("LATENCY", latency), ("FAILURE", failure), ("SEED", seed)):
+            if value is not None:
+                self.monkeypatch.setenv(f'PODMAN_STUB_{name}', str(value))
+
+    def calls(self, cmd=None):
+        '''
+        Return list of argument lists, optionally only those for a command.
+        '''
+        logfile = self.path / "calls.jsonl"
+        if not logfile.exists():
+            return []
+        ret = [json.loads(line) for line in logfile.read_text().splitlines()]
+        if cmd:
+            ret = [one for one in ret if one[0] == cmd]
+        return ret
+
+    def images(self):
+        imgfile = self.path / "images.json"
+        if not imgfile.exists():
+            return {}
+        return json.loads(imgfile.read_text())
+
+    def add_image(self, name, **data):
+        images = self.images()
+        images[name] = dict(dict(Id=name, Names=[name], Size=0, RootFS=dict(Layers=[name])), **data)
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / "images.json").write_text(json.dumps(images))
+
+
+@pytest.fixture
+def stub_podman(tmp_path, monkeypatch):
+    '''
+    Put the stub podman first in PATH with its state held in a temp dir.
+    '''
+    monkeypatch.setenv("PATH", f'{stub_bin}:{os.environ["PATH"]}')
+    monkeypatch.setenv("PODMAN_STUB_DIR", str(tmp_path / "podman"))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.delenv("WINCH_CONFIG", raising=False)
+    return StubPodman(tmp_path / "podman", monkeypatch)
@@ -0,0 +1,28 @@
+'''
+Tests of the stub podman simulation and the orchestration benchmark.
+'''
+from click.testing import CliRunner
+
+from winch.cli import cli
+from conftest import example_dir
+from bench_orchestration import bench
+
+
+def test_stub_failure(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stub_podman.configure(failure="build=1,*=0")
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", str(example_dir / "wct.toml"), "build",
+                              "-d", "debian-bookworm-minimal"])
+    assert got.exit_code != 0
+    assert "debian-bookworm-minimal" not in stub_podman.images()
+
+
+def test_bench(tmp_path):
+    results = bench(tmp_path, roots=1, variants=(2,), nextract=2)
+    assert results["build"]["failed"] == 0
+    assert results["build"]["instances"] == 3
+    assert results["build"]["podman_calls"] > 0
+    assert results["render"]["podman_calls"] == 0
+    assert results["extract"]["instances"] == 2
+    assert results["extract"]["failed"] == 0
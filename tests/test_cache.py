@@ -0,0 +1,59 @@
+#!/usr/bin/env pytest
+'''
+Test winch.cache
+'''
+from click.testing import CliRunner
+
+from winch.cli import cli
+from conftest import example_dir
+
+
+def test_cache_save_restore(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = str(example_dir / "contrived.toml")
+    cache_dir = str(tmp_path / "cache")
+    image = "debian-bookworm-edit"
+
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", config, "build", "-i", image])
+    assert got.exit_code == 0, got.output
+    assert len(stub_podman.calls("build")) == 1
+
+    got = runner.invoke(cli, ["-c", config, "cache", "save", "-C", cache_dir, "-i", image])
+    assert got.exit_code == 0, got.output
+    assert len(list((tmp_path / "cache").glob("*.tar"))) == 1
+
+    got = runner.invoke(cli, ["-c", config, "cache", "save", "-C", cache_dir, "-i", image])
+    assert len(stub_podman.calls("save")) == 1
+
+    # A fresh host restores instead of building.
+    (tmp_path / "podman" / "images.json").unlink()
+    got = runner.invoke(cli, ["-c", config, "build", "-C", cache_dir, "-i", image])
+    assert got.exit_code == 0, got.output
+    assert image in stub_podman.images()
+    assert len(stub_podman.calls("build")) == 1
+    assert len(stub_podman.calls("load")) == 1
+
+
+def test_cache_canonical(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = tmp_path / "tool.toml"
+    config.write_text('[base]\nimage = "debian:bookworm"\n\n'
+                      '[tool]\nparent_kind = "base"\nimage = "tool"\n'
+                      'containerfile = """\nFROM {parent[image]}\nrun   apt-get install -y b a\n"""\n')
+    config = str(config)
+    cache_dir = str(tmp_path / "cache")
+
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", config, "build", "--canonical", "-i", "tool"])
+    assert got.exit_code == 0, got.output
+    got = runner.invoke(cli, ["-c", config, "cache", "save", "-C", cache_dir, "-i", "tool"])
+    assert got.exit_code == 0, got.output
+
+    # A canonical build restores what was saved from the configured Containerfile.
+    (tmp_path / "podman" / "images.json").unlink()
+    got = runner.invoke(cli, ["-c", config, "build", "--canonical", "-C", cache_dir, "-i", "tool"])
+    assert got.exit_code == 0, got.output
+    assert "restored image from cache: tool" in got.output
+    assert len(stub_podman.calls("load")) == 1
+    assert len(stub_podman.calls("build")) == 1
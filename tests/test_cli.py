@@ -0,0 +1,326 @@
+#!/usr/bin/env pytest
+'''
+Test winch.cli commands using the stub podman.
+'''
+import json
+from pathlib import Path
+
+import pytest
+
+from click.testing import CliRunner
+
+from winch.cli import cli
+from winch.history import History
+from conftest import example_dir
+
+contrived = str(example_dir / "contrived.toml")
+
+
+def test_gc(stub_podman):
+    stub_podman.add_image("debian-bookworm-edit")
+    stub_podman.add_image("debian-bookworm-edit-old", Size=2000)
+    stub_podman.add_image("debian-bookworm-edit-busy", Size=1000, InUse=True)
+    stub_podman.add_image("unrelated", Size=3000)
+
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", contrived, "gc", "-n"])
+    assert got.exit_code == 0, got.output
+    assert "debian-bookworm-edit-old" in got.output
+    assert "unrelated" not in got.output
+    assert not stub_podman.calls("rmi")
+
+    got = runner.invoke(cli, ["-c", contrived, "gc"])
+    assert got.exit_code == 0, got.output
+    assert len(stub_podman.calls("rmi")) == 1
+    images = stub_podman.images()
+    assert "debian-bookworm-edit-old" not in images
+    assert "debian-bookworm-edit-busy" in images
+    assert "debian-bookworm-edit" in images
+
+    got = runner.invoke(cli, ["-c", contrived, "gc", "-f"])
+    assert got.exit_code == 0, got.output
+    assert "debian-bookworm-edit-busy" not in stub_podman.images()
+    assert "unrelated" in stub_podman.images()
+
+
+def test_list_formats():
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", contrived, "list", "-F", "jsonl", "--fields", "image,kpath,node"])
+    assert got.exit_code == 0, got.output
+    lines = got.output.splitlines()
+    assert len(lines) == 12
+    rec = json.loads(lines[0])
+    assert list(rec) == ["image", "kpath", "node"]
+    assert rec["image"] == "debian:bookworm"
+
+    got = runner.invoke(cli, ["-c", contrived, "list", "-F", "tsv", "--fields", "image,kpath",
+                              "--chunk", "5", "-k", "edit"])
+    assert got.exit_code == 0, got.output
+    assert got.output.splitlines()[0] == "debian-bookworm-edit\tdebian,edit"
+
+
+def test_dot(tmp_path):
+    output = tmp_path / "out.dot"
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", contrived, "dot", "-o", str(output), "-d", "debian-bookworm-edit",
+                              "-t", "{image}", "--cluster"])
+    assert got.exit_code == 0, got.output
+    text = output.read_text()
+    assert text.startswith("digraph winch {")
+    assert text.count("->") == 1
+    assert '"cluster_edit"' in text
+    assert 'label="debian:bookworm"' in text
+
+
+def test_build_fused(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", str(example_dir / "wct.toml"), "build", "--fuse",
+                              "-d", "debian-bookworm-minimal-spack-wct-master-view"])
+    assert got.exit_code == 0, got.output
+    builds = stub_podman.calls("build")
+    assert len(builds) == 1
+    assert len(stub_podman.calls("pull")) == 1
+    assert sorted(stub_podman.images()) == ["debian-bookworm-minimal-spack-wct-master-view",
+                                            "debian:bookworm"]
+
+
+
+def test_build_fused_manifest(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    config = str(example_dir / "wct.toml")
+    got = runner.invoke(cli, ["-c", config, "list", "-d", "debian-bookworm-minimal-spack-wct-master-view",
+                              "-t", "{node}"])
+    assert got.exit_code == 0, got.output
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps(dict(
+        load=[], build=got.output.split(),
+        save={"debian-bookworm-minimal-spack": str(tmp_path / "spack.tar")})))
+    got = runner.invoke(cli, ["-c", config, "build", "--fuse", "-m", str(manifest)])
+    assert got.exit_code == 0, got.output
+    assert "debian-bookworm-minimal-spack" in stub_podman.images()
+    assert "debian-bookworm-minimal" not in stub_podman.images()
+    assert (tmp_path / "spack.tar").exists()
+    # A fused build is not the cost of any one I-node.
+    assert not History().builds()
+
+
+def test_build_fused_options(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    base = ["-c", str(example_dir / "wct.toml"), "build", "--fuse", "-d", "debian-bookworm-minimal-spack"]
+    for bad in (["-f", "deps"], ["-r", "last"], ["-C", str(tmp_path / "cache")]):
+        got = runner.invoke(cli, base + bad)
+        assert got.exit_code == 2, got.output
+    assert not stub_podman.calls("build")
+
+    got = runner.invoke(cli, base + ["--tag-stages", "-f", "all", "--squash"])
+    assert got.exit_code == 0, got.output
+    fused, stage = stub_podman.calls("build")
+    assert "--no-cache" in fused and "--squash" in fused
+    assert "--no-cache" not in stage and "--squash" in stage
+
+    # A failed stage tag is a failure that --keep-going continues after.
+    monkeypatch.setenv("PODMAN_STUB_BUILD_FAIL", "debian-bookworm-minimal")
+    got = runner.invoke(cli, base + ["--tag-stages", "--keep-going"])
+    assert got.exit_code == 1
+    state = json.loads((tmp_path / "winch-build-state.json").read_text())["nodes"]
+    status = {s["image"]: s["status"] for s in state.values()}
+    assert status["debian-bookworm-minimal"] == "failed"
+    assert status["debian-bookworm-minimal-spack"] == "built"
+
+def test_pull(stub_podman):
+    stub_podman.add_image("debian:bookworm")
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", contrived, "pull", "-j", "3"])
+    assert got.exit_code == 0, got.output
+    pulled = sorted(c[-1] for c in stub_podman.calls("pull"))
+    assert pulled == ["almalinux:8", "almalinux:9", "debian:trixie"]
+
+
+def test_build_prefetch(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", contrived, "build", "-k", "devel", "--pull-jobs", "4"])
+    assert got.exit_code == 0, got.output
+    calls = stub_podman.calls()
+    for num, call in enumerate(calls):
+        if call[0] != "build":
+            continue
+        base = call[call.index("-t") + 1].rsplit("-", 1)[0]
+        assert ["pull", base] in calls[:num]
+
+
+def test_sizes(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", contrived, "build", "-d", "debian-bookworm-edit"])
+    assert got.exit_code == 0, got.output
+    ncalls = len(stub_podman.calls())
+
+    got = runner.invoke(cli, ["-c", contrived, "sizes", "-F", "json"])
+    assert got.exit_code == 0, got.output
+    assert len(stub_podman.calls()) == ncalls + 2
+    sizes = json.loads(got.output)
+    byname = {one["image"]: one for one in sizes["images"]}
+    edit, base = byname["debian-bookworm-edit"], byname["debian:bookworm"]
+    assert edit["added_layers"] == 2
+    assert edit["size"] == base["size"] + edit["added_size"]
+    assert sizes["kinds"]["edit"] == edit["added_size"]
+
+
+def test_build_stream(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", str(example_dir / "wct.toml"), "build", "--stream",
+                              "-d", "debian-bookworm-minimal-spack-wct-master-view"])
+    assert got.exit_code == 0, got.output
+    assert not (tmp_path / "winch-contexts").exists()
+    builds = stub_podman.calls("build")
+    assert len(builds) == 4
+    assert all(b[-1] == "-" for b in builds)
+    assert "debian-bookworm-minimal-spack-wct-master-view" in stub_podman.images()
+
+
+def test_test(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for image in ("debian-bookworm-edit", "debian-trixie-edit", "alma-8-edit"):
+        stub_podman.add_image(image)
+    runner = CliRunner()
+    template = 'case {image} in *trixie*) exit 1;; alma*) sleep 5;; *) echo ok {release};; esac'
+    got = runner.invoke(cli, ["-c", contrived, "test", "-k", "edit", "-t", template, "-j", "4",
+                              "--timeout", "1", "-o", "summary.json"])
+    assert got.exit_code == 1
+    results = {r["image"]: r for r in json.loads((tmp_path / "summary.json").read_text())}
+    assert results["debian-bookworm-edit"]["status"] == "pass"
+    assert results["debian-trixie-edit"]["status"] == "fail"
+    assert results["alma-8-edit"]["status"] == "timeout"
+    assert results["alma-9-edit"]["status"] == "fail" # no such image
+    assert "ok" in (tmp_path / "winch-tests" / "debian-bookworm-edit.log").read_text()
+
+    got = runner.invoke(cli, ["-c", contrived, "test", "-i", "debian-bookworm-edit", "-t", "true",
+                              "-F", "junit", "-o", "junit.xml"])
+    assert got.exit_code == 0, got.output
+    assert 'failures="0"' in (tmp_path / "junit.xml").read_text()
+
+
+def test_push(stub_podman):
+    for image in ("debian:bookworm", "debian-bookworm-edit"):
+        stub_podman.add_image(image)
+    runner = CliRunner()
+    args = ["-c", contrived, "push", "-d", "debian-bookworm-edit", "-r", "localhost:5000/winch",
+            "--no-tls-verify", "-j", "3"]
+    got = runner.invoke(cli, args)
+    assert got.exit_code == 0, got.output
+    pushed = [c[-1] for c in stub_podman.calls("push")]
+    assert pushed == ["localhost:5000/winch/debian:bookworm",
+                      "localhost:5000/winch/debian-bookworm-edit"]
+    assert all("--tls-verify=false" in c for c in stub_podman.calls("push"))
+
+    # Nothing changed so nothing is pushed.
+    got = runner.invoke(cli, args)
+    assert got.exit_code == 0, got.output
+    assert len(stub_podman.calls("push")) == 2
+    assert got.output.count("present:") == 2
+
+    # A rebuilt image is pushed again.
+    stub_podman.add_image("debian-bookworm-edit", Id="rebuilt")
+    got = runner.invoke(cli, args)
+    assert got.exit_code == 0, got.output
+    assert stub_podman.calls("push")[-1][-1] == "localhost:5000/winch/debian-bookworm-edit"
+    assert len(stub_podman.calls("push")) == 3
+
+    # A failed parent push blocks the push of its children.
+    stub_podman.configure(failure="push=1,*=0")
+    got = runner.invoke(cli, args + ["-f", "-r", "other.io/winch/{image}"])
+    assert got.exit_code == 1
+    assert "failed: debian:bookworm -> other.io/winch/debian:bookworm" in got.output
+    assert "blocked: debian-bookworm-edit -> other.io/winch/debian-bookworm-edit" in got.output
+
+
+def test_build_canonical(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    contents = dict()
+    for name, run in (("one", "RUN apt-get install -y \\\\\n# winch: sort\n    b a\n# winch: end"),
+                      ("two", "# packages\nrun   apt-get install -y a  b")):
+        config = tmp_path / f'{name}.toml'
+        config.write_text(f'[base]\nimage = "debian:bookworm"\n\n'
+                          f'[tool]\nparent_kind = "base"\nimage = "tool"\n'
+                          f'containerfile = """\nFROM {{parent[image]}}\n{run}\n"""\n')
+        got = runner.invoke(cli, ["-c", str(config), "build", "--explain", "-i", "tool",
+                                  "-o", f'{name}/Containerfile'])
+        assert got.exit_code == 0, got.output
+        assert "+++ tool/Containerfile (canonical)" in got.output
+        contents[name] = (tmp_path / name / "Containerfile").read_text()
+    assert contents["one"] == contents["two"] == "FROM debian:bookworm\nRUN apt-get install -y a b\n"
+
+
+def test_build_keep_going(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = tmp_path / "chain.toml"
+    config.write_text('''
+[base]
+image = "debian:bookworm"
+[one]
+parent_kind = "base"
+image = "one"
+containerfile = "FROM {parent[image]}"
+[two]
+parent_kind = "one"
+image = "two"
+containerfile = "FROM {parent[image]}"
+[other]
+parent_kind = "base"
+image = "other"
+containerfile = "FROM {parent[image]}"
+''')
+    monkeypatch.setenv("PODMAN_STUB_BUILD_FAIL", "one")
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", str(config), "build", "-i", "all"])
+    assert got.exit_code != 0
+    assert "other" not in stub_podman.images()
+
+    got = runner.invoke(cli, ["-c", str(config), "build", "-i", "all", "--keep-going"])
+    assert got.exit_code == 1
+    state = json.loads((tmp_path / "winch-build-state.json").read_text())["nodes"]
+    status = {s["image"]: s["status"] for s in state.values()}
+    assert status == {"debian:bookworm": "skipped", "one": "failed", "two": "blocked", "other": "built"}
+    assert "other" in stub_podman.images()
+
+    # Resuming builds only what failed or was blocked, without checking the rest.
+    monkeypatch.delenv("PODMAN_STUB_BUILD_FAIL")
+    ncalls = len(stub_podman.calls())
+    got = runner.invoke(cli, ["-c", str(config), "build", "-i", "all", "--resume"])
+    assert got.exit_code == 0, got.output
+    calls = stub_podman.calls()[ncalls:]
+    assert [c[c.index("-t") + 1] for c in calls if c[0] == "build"] == ["one", "two"]
+    assert not [c for c in calls if "other" in c]
+
+
+def test_diff(tmp_path):
+    new = tmp_path / "new.toml"
+    new.write_text(Path(contrived).read_text().replace("emacs", "vim"))
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-j", "2", "diff", "-F", "json", "-c", contrived, "-c2", str(new)])
+    assert got.exit_code == 0, got.output
+    report = json.loads(got.output)
+    assert not report["added"] and not report["removed"]
+    assert sorted(m["image"] for m in report["modified"]) == [
+        "alma-8-edit", "alma-9-edit", "debian-bookworm-edit", "debian-trixie-edit"]
+
+
+@pytest.mark.parametrize("fuse", [[], ["--fuse"]])
+def test_build_keep_going_pull(stub_podman, tmp_path, monkeypatch, fuse):
+    monkeypatch.chdir(tmp_path)
+    stub_podman.add_image("debian:bookworm")
+    stub_podman.configure(failure="pull=1,*=0")
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", contrived, "build", "-k", "edit", "--keep-going"] + fuse)
+    assert got.exit_code == 1
+    assert isinstance(got.exception, SystemExit)
+    state = json.loads((tmp_path / "winch-build-state.json").read_text())["nodes"]
+    status = {s["image"]: s["status"] for s in state.values()}
+    assert status == {"debian-bookworm-edit": "built", "debian-trixie-edit": "failed",
+                      "alma-8-edit": "failed", "alma-9-edit": "failed"}
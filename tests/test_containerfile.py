@@ -0,0 +1,85 @@
+#!/usr/bin/env pytest
+'''
+Test winch.containerfile
+'''
+import pytest
+
+from winch.containerfile import fuse, canonical, explain
+
+
+def test_fuse():
+    layers = [
+        ("s0", "debian:bookworm", "FROM debian:bookworm\nRUN one\n"),
+        ("s1", "first", "FROM --platform=linux/amd64 first AS named\nRUN two\n"),
+        ("s2", "second", "FROM other AS helper\nRUN three\nFROM second\nCOPY --from=helper /a /b\n"),
+    ]
+    text = fuse(layers)
+    assert [l for l in text.splitlines() if l.startswith("FROM")] == [
+        "FROM debian:bookworm AS s0",
+        "FROM --platform=linux/amd64 s0 AS s1",
+        "FROM other AS helper",
+        "FROM s1 AS s2",
+    ]
+
+    with pytest.raises(ValueError):
+        fuse([("s0", None, "FROM a\n"), ("s1", "b", "FROM c\n")])
+
+
+def test_canonical():
+    one = '''# syntax=docker/dockerfile:1
+FROM  debian:bookworm
+# install things
+RUN apt update \\
+    && apt-get install -y \\
+    # winch: sort
+      zlib1g  curl \\
+      bash \\
+    # winch: end
+    && apt-get clean   
+RUN echo "a   b"
+COPY <<EOF /etc/motd
+  hello    world
+# not a comment
+EOF
+'''
+    two = '''# syntax=docker/dockerfile:1
+from debian:bookworm
+
+RUN apt update && apt-get install -y \\
+# winch: sort
+  bash curl \\
+  zlib1g \\
+# winch: end
+  && apt-get clean
+RUN   echo "a   b"
+COPY <<EOF /etc/motd
+  hello    world
+# not a comment
+EOF
+'''
+    canon = canonical(one)
+    assert canon == canonical(two)
+    assert canonical(canon) == canon
+    assert canon.splitlines()[:4] == [
+        "# syntax=docker/dockerfile:1",
+        "FROM debian:bookworm",
+        "RUN apt update && apt-get install -y bash curl zlib1g && apt-get clean",
+        'RUN echo "a   b"']
+    assert "  hello    world\n# not a comment\nEOF\n" in canon
+    assert "+FROM debian:bookworm" in explain(one, canon)
+    assert explain(canon, canon) == ""
+
+    # Continued lines are appended as they are, as podman joins them.
+    assert canonical('RUN wget https://example.com/long/\\\npath/file.tgz\n') == \
+        'RUN wget https://example.com/long/path/file.tgz\n'
+    assert canonical('RUN echo "a \\\n    b"\n') == 'RUN echo "a     b"\n'
+    assert canonical('RUN echo a \\  \n\n    # note\n    b\n') == 'RUN echo a b\n'
+
+
+def test_canonical_sort_instructions():
+    text = "FROM x\n# winch: sort\nENV B=2\nenv A=1\n# winch: end\nRUN true\n"
+    assert canonical(text) == "FROM x\nENV A=1\nENV B=2\nRUN true\n"
+    with pytest.raises(ValueError):
+        canonical("FROM x\n# winch: sort\nENV B=2\n")
+    with pytest.raises(ValueError):
+        canonical("FROM x\n# winch: end\n")
@@ -0,0 +1,56 @@
+#!/usr/bin/env pytest
+'''
+Test winch.graph
+'''
+from winch.config import load
+from winch.graph import Graph
+from conftest import example_dir
+from bench_orchestration import synthetic_config
+
+
+def test_schedule():
+    gr = Graph(**load(example_dir / "contrived.toml"))
+    inodes = list(gr.I.nodes)
+    slow = gr.from_kind("devel")[-1]
+    order = gr.schedule(inodes, lambda n: 100 if n == slow else 1)
+    assert sorted(order) == sorted(inodes)
+    for num, inode in enumerate(order):
+        for dep in gr.ipath(inode)[:-1]:
+            assert order.index(dep) < num
+    # the slow I-node's parent goes first and it goes as soon as possible
+    assert order[0] == gr.ipath(slow)[0]
+    assert order[1] == slow
+
+
+def test_parallel_generate(tmp_path):
+    # A single root kind is partitioned by the variants below it.
+    synthetic_config(tmp_path / "single.toml", roots=1, variants=(4, 3))
+    assert len(Graph(**load(tmp_path / "single.toml")).partitions()) == 4
+    for path in (example_dir / "contrived.toml", example_dir / "wct.toml",
+                 example_dir / "spng.toml", tmp_path / "single.toml"):
+        config = load(path)
+        serial = Graph(**config)
+        parallel = Graph()
+        parallel.set_kinds(**config)
+        parallel.generate(4)
+        assert list(parallel.I.nodes.data()) == list(serial.I.nodes.data())
+        assert list(parallel.I.edges) == list(serial.I.edges)
+
+
+def test_diff():
+    from winch.graph import diff
+    config = load(example_dir / "wct.toml")
+    old = Graph(**config)
+    config["spack"]["containerfile"] += "RUN true\n"
+    config["wctdev"]["gitref"] = ["master", "0.30.x"]
+    new = Graph(**config)
+
+    added, removed, modified = diff(old, new)
+    images = lambda gr, inodes: {gr.data(n)["image"] for n in inodes}
+    assert images(new, added) == {"debian-bookworm-minimal-spack-wct-master-view-wctdev-0.30.x",
+                                  "debian-bookworm-minimal-spack-wct-master-view-wctdev-0.30.x-datarepo"}
+    assert len(removed) == 4
+    # the spack layer and everything built on it except the added
+    assert "debian-bookworm-minimal-spack" in images(new, modified)
+    assert "debian-bookworm-minimal" not in images(new, modified)
+    assert len(modified) == 5
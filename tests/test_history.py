@@ -0,0 +1,54 @@
+#!/usr/bin/env pytest
+'''
+Test winch.history
+'''
+from click.testing import CliRunner
+
+from winch.history import History
+from winch.cli import cli
+from conftest import example_dir
+
+
+def test_history(tmp_path):
+    hist = History(tmp_path / "history.db")
+    for duration in (10, 11, 30):
+        hist.record("abc", "slow", 0, duration, 0)
+    hist.record("def", "fast", 0, 1, 0)
+    hist.record("def", "fast", 0, 100, 1)
+    assert hist.slowest(1)[0][0] == "slow"
+    assert [r[0] for r in hist.regressions()] == ["slow"]
+    costs = hist.costs()
+    assert costs["abc"] == costs["slow"] == 17
+    assert costs["fast"] == 1
+
+
+def test_build_records(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = str(example_dir / "contrived.toml")
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", config, "build", "-k", "edit"])
+    assert got.exit_code == 0, got.output
+    builds = History().builds()
+    assert len(builds) == 4
+    assert all(b["status"] == 0 and b["image_id"] for b in builds)
+
+    got = runner.invoke(cli, ["history", "-i", "debian-bookworm-edit"])
+    assert got.exit_code == 0, got.output
+    assert len(got.output.splitlines()) == 1
+
+
+def test_build_interrupted(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def interrupt(*args):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr("winch.cli.build_context", interrupt)
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", str(example_dir / "contrived.toml"), "build",
+                              "-i", "debian-bookworm-edit"])
+    assert got.exit_code != 0
+    builds = History().builds()
+    assert len(builds) == 1
+    assert builds[0]["status"] != 0
+    assert not History().costs()
@@ -0,0 +1,97 @@
+#!/usr/bin/env pytest
+'''
+Test winch.shard
+'''
+import json
+from functools import partial
+
+from click.testing import CliRunner
+
+from winch.config import load
+from winch.graph import Graph
+from winch.shard import partition, node_cost, default_costs
+from winch.cli import cli
+from conftest import example_dir
+
+
+def test_partition():
+    gr = Graph(**load(example_dir / "wct.toml"))
+    inodes = list(gr.I.nodes)
+    shared, shards = partition(gr, inodes, 3, partial(node_cost, gr))
+    assert len(shards) == 3
+
+    # every I-node is built exactly once
+    everything = shared + sum(shards, [])
+    assert sorted(everything) == sorted(inodes)
+
+    # each shard depends only on itself and the shared I-nodes
+    for members in shards:
+        for inode in members:
+            for dep in gr.ipath(inode):
+                assert dep in members or dep in shared
+
+
+def test_shard_build(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = str(example_dir / "wct.toml")
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", config, "shard", "-n", "3"])
+    assert got.exit_code == 0, got.output
+
+    got = runner.invoke(cli, ["-c", config, "build", "-m", "winch-shards/base.json"])
+    assert got.exit_code == 0, got.output
+    assert "no instances found" not in got.output
+    assert stub_podman.calls("save")
+
+    for num in (1,2,3):
+        man = json.loads((tmp_path / f"winch-shards/shard-{num}.json").read_text())
+        got = runner.invoke(cli, ["-c", config, "build", "-m", f"winch-shards/shard-{num}.json"])
+        assert got.exit_code == 0, got.output
+        for image in man["images"]:
+            assert image in stub_podman.images()
+    assert stub_podman.calls("load")
+
+
+def test_shard_build_pulled_base(stub_podman, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = str(example_dir / "contrived.toml")
+    runner = CliRunner()
+    got = runner.invoke(cli, ["-c", config, "shard", "-n", "3"])
+    assert got.exit_code == 0, got.output
+    base = json.loads((tmp_path / "winch-shards/base.json").read_text())
+    assert not base["save"]
+    for name in ["base"] + [f"shard-{num}" for num in (1,2,3)]:
+        man = json.loads((tmp_path / f"winch-shards/{name}.json").read_text())
+        assert not man["load"]
+        got = runner.invoke(cli, ["-c", config, "build", "-m", f"winch-shards/{name}.json"])
+        assert got.exit_code == 0, got.output
+        for image in man["images"]:
+            if "-" in image:
+                assert image in stub_podman.images()
+
+
+def test_default_costs():
+    gr = Graph(**load(example_dir / "contrived.toml"))
+    byimage = {gr.data(n)["image"]: n for n in gr.I.nodes}
+    costs = {"debian-bookworm-edit": 100.0, "debian:bookworm-devel": 10.0}
+    defaults = default_costs(gr, costs)
+    assert defaults == {"edit": 100.0, "devel": 10.0, None: 55.0}
+    cost = partial(node_cost, gr, costs=costs, defaults=defaults)
+    assert cost(byimage["alma-8-edit"]) == 100.0
+    assert cost(byimage["almalinux:9-devel"]) == 10.0
+    assert cost(byimage["almalinux:9"]) == 0.0
+
+
+def test_partition_balance():
+    gr = Graph(**load(example_dir / "wct.toml"))
+    cost = partial(node_cost, gr)
+    shared, shards = partition(gr, list(gr.I.nodes), 2, cost)
+    # The debian chain to its first branch is shared and its wctdev subtrees spread.
+    assert sum(cost(n) for n in shared) == 4
+    assert max(sum(cost(n) for n in members) for members in shards) == 4
+
+    gr = Graph(**load(example_dir / "spng.toml"))
+    cost = partial(node_cost, gr)
+    shared, shards = partition(gr, list(gr.I.nodes), 4, cost)
+    assert all(shards)
+    assert sum(cost(n) for n in shared) + max(sum(cost(n) for n in m) for m in shards) < 10
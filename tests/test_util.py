@@ -3,7 +3,9 @@
 Test winch.util
 '''
 
-from winch.util import self_format, TempDir
+import pytest
+
+from winch.util import self_format, TempDir, Template, SafeDict, split_field_name
 
 def test_self_format():
     p = dict(kind="debian", release="bookworm")
@@ -27,3 +29,25 @@ def test_tempdir():
 
     assert not tmp.exists()
     
+
+def test_template():
+    data = dict(image="debian:bookworm", parent=dict(release="bookworm"), width=18)
+    for text in ("{image} {node}", "{parent[release]}-{missing}",
+                 "{{literal}} {image!r:>{width}}", "no fields"):
+        want = text.format_map(SafeDict(node="abc", **data))
+        assert Template(text).render(data, node="abc") == want
+    assert Template("{missing[key]}").render(data) == "{missing[key]}"
+    got = list(Template("{node}:{image}").render_many([("a", data), ("b", data)]))
+    assert got == ["a:debian:bookworm", "b:debian:bookworm"]
+
+
+def test_split_field_name():
+    assert split_field_name("image") == ("image", ())
+    assert split_field_name("parent[release]") == ("parent", ((False, "release"),))
+    assert split_field_name("a.b[0][k].c") == ("a", ((True, "b"), (False, 0), (False, "k"), (True, "c")))
+    assert split_field_name("0") == (0, ())
+    for bad in ("a.", "a[b", "a[b]c"):
+        with pytest.raises(ValueError):
+            split_field_name(bad)
+    data = dict(items=["x", "y"])
+    assert Template("{items[1]}").render(data) == "{items[1]}".format(**data)
@@ -0,0 +1,13 @@
+#!/usr/bin/env pytest
+'''
+Test winch.viz
+'''
+from winch.viz import quote
+
+
+def test_quote():
+    assert quote('plain') == '"plain"'
+    assert quote('say "hi"') == '"say \\"hi\\""'
+    assert quote('two\nlines') == '"two\\nlines"'
+    assert quote('a\\') == '"a\\\\"'
+    assert quote('a\\"b') == '"a\\\\\\"b"'